@@ -1,35 +1,150 @@
 import asyncio
 import logging
+import sys
 from datetime import datetime
+from typing import List, Optional, Tuple
 
 
 class DatabaseLogHandler(logging.Handler):
-    """Логгер, сохраняющий записи в таблицу log_entries."""
+    """Логгер, сохраняющий записи в таблицу log_entries.
+
+    Записи складываются в очередь и пишутся в БД пачками через COPY
+    одной фоновой задачей, а не отдельным INSERT на каждую строку.
+    При остановке бота aclose() дожидается текущей записи и дописывает остаток очереди.
+    """
+
+    COLUMNS = ('created_at', 'logger', 'level', 'message')
+    BATCH_SIZE = 500
+    FLUSH_DELAY = 0.2
+    QUEUE_SIZE = 10000
+    # Сколько aclose() ждет, пока фоновая задача допишет текущие пачки
+    CLOSE_TIMEOUT = 5.0
+    # Метка в очереди: все записи до нее дописаны, фоновая задача завершается
+    _STOP = object()
 
     def __init__(self, pool):
         super().__init__()
         self.pool = pool
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        self._drain_task: Optional[asyncio.Task] = None
+        # Пачка, которая собирается или пишется прямо сейчас: если при остановке
+        # запись не уложилась в CLOSE_TIMEOUT, ее размер сообщается в stderr
+        self._batch: List[Tuple[datetime, str, str, str]] = []
+        # Сколько записей отброшено из-за переполнения очереди
+        self._dropped = 0
+        self._closed = False
 
-    async def _write(self, record: logging.LogRecord):
-        message = self.format(record)
-        created_at = datetime.fromtimestamp(record.created)
+    def _take_dropped_notice(self) -> List[Tuple[datetime, str, str, str]]:
+        """Служебная строка о потерянных записях, чтобы переполнение было видно в журнале"""
+        if not self._dropped:
+            return []
+        dropped, self._dropped = self._dropped, 0
+        return [(
+            datetime.now(),
+            __name__,
+            'WARNING',
+            f"Очередь журнала переполнена, отброшено записей: {dropped}",
+        )]
 
+    def _report_failure(self, count: int, err: Exception):
+        # Не логируем ошибку через logging, чтобы не зациклиться
+        sys.stderr.write(f"DatabaseLogHandler: не удалось записать {count} записей журнала: {err!r}\n")
+
+    async def _write(self, batch: List[Tuple[datetime, str, str, str]]):
         async with self.pool.acquire() as conn:
-            await conn.execute(
-                '''
-                INSERT INTO log_entries (created_at, logger, level, message)
-                VALUES ($1, $2, $3, $4)
-                ''',
-                created_at,
-                record.name,
-                record.levelname,
-                message,
+            await conn.copy_records_to_table(
+                'log_entries',
+                records=batch,
+                columns=self.COLUMNS,
             )
 
+    async def _drain(self):
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is self._STOP:
+                return
+            self._batch = [item]
+            # Небольшая задержка, чтобы собрать пачку при всплеске логов
+            await asyncio.sleep(self.FLUSH_DELAY)
+            try:
+                while len(self._batch) < self.BATCH_SIZE:
+                    item = self.queue.get_nowait()
+                    if item is self._STOP:
+                        stopping = True
+                        break
+                    self._batch.append(item)
+            except asyncio.QueueEmpty:
+                pass
+            self._batch.extend(self._take_dropped_notice())
+
+            try:
+                await self._write(self._batch)
+            except Exception as err:
+                self._report_failure(len(self._batch), err)
+            self._batch = []
+
     def emit(self, record: logging.LogRecord):
+        if self._closed:
+            return
         try:
             loop = asyncio.get_running_loop()
         except RuntimeError:
             return
 
-        loop.create_task(self._write(record))
+        if self._drain_task is None or self._drain_task.done():
+            self._drain_task = loop.create_task(self._drain())
+
+        try:
+            self.queue.put_nowait((
+                datetime.fromtimestamp(record.created),
+                record.name,
+                record.levelname,
+                self.format(record),
+            ))
+        except asyncio.QueueFull:
+            # При переполнении отбрасываем новые записи, а не блокируем цикл событий;
+            # их число попадет в журнал служебной строкой со следующей пачкой
+            self._dropped += 1
+
+    async def _stop_drain(self, task: asyncio.Task):
+        # Метка встает в конец очереди: все, что пришло раньше, будет дописано
+        await self.queue.put(self._STOP)
+        # shield: по таймауту wait_for не должен отменить запись на середине
+        await asyncio.shield(task)
+
+    async def aclose(self):
+        """Дожидается записи текущих пачек и одним COPY дописывает остаток очереди"""
+        self._closed = True
+        task, self._drain_task = self._drain_task, None
+        if task is not None and not task.done():
+            try:
+                await asyncio.wait_for(self._stop_drain(task), self.CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                # Запись зависла: отменяем, незавершенную пачку не повторяем,
+                # чтобы не задвоить строки, если COPY все же прошел
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                if self._batch:
+                    self._report_failure(len(self._batch), asyncio.TimeoutError("запись не завершилась при остановке"))
+                    self._batch = []
+
+        batch = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if item is not self._STOP:
+                batch.append(item)
+        batch.extend(self._take_dropped_notice())
+
+        if batch:
+            try:
+                await self._write(batch)
+            except Exception as err:
+                self._report_failure(len(batch), err)
+        self.close()
@@ -6,7 +6,8 @@ import logging
 from db_logger import DatabaseLogHandler
 from datetime import datetime, timedelta, date, time, timezone
 from calendar import monthrange
-from typing import Dict, Optional
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, List, Optional, Tuple
+from contextvars import ContextVar
 import math
 import io
 import smtplib
@@ -16,11 +17,16 @@ from email.mime.text import MIMEText
 from email import encoders
 
 import holidays
+import numpy as np
+from cachetools import TTLCache
+import orjson
 from openpyxl import Workbook
 import asyncpg
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -32,6 +38,40 @@ from zoneinfo import ZoneInfo
 
 MOSCOW_TZ = ZoneInfo("Europe/Moscow")
 
+# Время начала обработки текущего апдейта (ставится middleware)
+_update_now: ContextVar[Optional[datetime]] = ContextVar("update_now", default=None)
+
+# Заголовки листов журнала действий
+ACTION_LOG_HEADERS = (
+    "Дата",
+    "Сотрудник",
+    "Должность",
+    "Роль",
+    "Объект",
+    "Статус",
+    "Приход",
+    "Широта прихода",
+    "Долгота прихода",
+    "Уход",
+    "Широта ухода",
+    "Долгота ухода",
+    "Часы",
+)
+GEO_LOG_HEADERS = (
+    "Время (МСК)",
+    "Сотрудник",
+    "Должность",
+    "Роль",
+    "Действие",
+    "Объект",
+    "Широта",
+    "Долгота",
+    "Расстояние до объекта, м",
+    "Точность, м",
+    "Пометка",
+    "Причина",
+)
+
 # Настройка
 load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -41,11 +81,22 @@ class Config:
     BOT_TOKEN = os.getenv("BOT_TOKEN", "")
     ADMIN_IDS = [int(x.strip()) for x in os.getenv("ADMIN_IDS", "467500951").split(",")]
     DATABASE_URL = os.getenv("DATABASE_URL", "")
+    REDIS_URL = os.getenv("REDIS_URL", "")
     GEO_REQUIRED = os.getenv("GEO_REQUIRED", "true").lower() == "true"
     LOCATION_RADIUS = int(os.getenv("LOCATION_RADIUS", "1000"))
     LOCATION_MAX_AGE_SECONDS = int(os.getenv("LOCATION_MAX_AGE_SECONDS", "300"))
     LOCATION_MAX_ACCURACY = float(os.getenv("LOCATION_MAX_ACCURACY", "250"))
     LOCATION_SECONDARY_RADIUS_MULT = float(os.getenv("LOCATION_SECONDARY_RADIUS_MULT", "2"))
+    OBJECTS_CACHE_TTL = int(os.getenv("OBJECTS_CACHE_TTL", "60"))
+    # Кэш прав сотрудников сбрасывается только правками через админку бота:
+    # изменения мимо бота (вручную в БД) видны не позже чем через EMPLOYEES_CACHE_TTL секунд.
+    # Админ-права кэш не использует и проверяются по БД
+    EMPLOYEES_CACHE_TTL = int(os.getenv("EMPLOYEES_CACHE_TTL", "300"))
+    DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+    DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+    DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+    DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", "1800"))
+    DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
     SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
     SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
     SMTP_USERNAME = os.getenv("SMTP_USERNAME", "")
@@ -65,23 +116,46 @@ if Config.DATABASE_URL:
 else:
     logger.error("DATABASE_URL не установлен!")
     
+def calculate_hours(check_in: Optional[datetime], check_out: datetime) -> int:
+    """Отработанные часы: округление вверх до целого часа, не больше MAX_WORK_HOURS"""
+    if not check_in:
+        return 0
+    hours = math.ceil((check_out - check_in).total_seconds() / 3600)
+    return min(max(0, hours), Config.MAX_WORK_HOURS)
+
+# То же правило, что в calculate_hours, для UPDATE ... SET hours_worked.
+# Каждый запрос с этим выражением обязан передавать параметры именно так:
+# $2 — время ухода, $3 — MAX_WORK_HOURS (остальные номера свободны под свои нужды).
+# При check_in IS NULL дает 0, так как GREATEST игнорирует NULL
+HOURS_WORKED_SQL = "LEAST($3, GREATEST(0, CEIL(EXTRACT(EPOCH FROM ($2 - check_in)) / 3600)))"
+
 # Простая функция расчета расстояния (в километрах)
+EARTH_RADIUS_M = 6371000.0
+_DEG2RAD = math.pi / 180.0
+
 def calculate_distance(lat1, lon1, lat2, lon2):
     """Упрощенный расчет расстояния между двумя точками (в метрах)"""
-    if not all([lat1, lon1, lat2, lon2]):
+    if not (lat1 and lon1 and lat2 and lon2):
         return float('inf')
     
     # Преобразуем градусы в радианы
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    lat1 = float(lat1) * _DEG2RAD
+    lat2 = float(lat2) * _DEG2RAD
     
     # Формула гаверсинусов
     dlat = lat2 - lat1
-    dlon = lon2 - lon1
+    dlon = (float(lon2) - float(lon1)) * _DEG2RAD
     a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    r = 6371000  # Радиус Земли в метрах
     
-    return c * r
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+def calculate_distances_vec(lat, lon, lats_rad: np.ndarray, lons_rad: np.ndarray, cos_lats: np.ndarray) -> np.ndarray:
+    """Расстояния (в метрах) от точки до массива точек, заданных в радианах"""
+    phi = lat * _DEG2RAD
+    dphi = lats_rad - phi
+    dlmb = lons_rad - lon * _DEG2RAD
+    a = np.sin(dphi / 2) ** 2 + math.cos(phi) * cos_lats * np.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
 
 # Состояния
 class Form(StatesGroup):
@@ -95,21 +169,97 @@ class Form(StatesGroup):
     waiting_for_manual_note = State()
     waiting_for_manual_photo = State()
 
+class ManualRequestCallback(CallbackData, prefix="manual"):
+    """Решение администратора по ручной отметке"""
+    action: str
+    req_id: int
+
 # Основной класс бота
 class WorkTimeBot:
     def __init__(self):
-        self.bot = Bot(token=Config.BOT_TOKEN)
-        self.dp = Dispatcher(storage=MemoryStorage())
+        # orjson вместо стандартного json для разбора апдейтов и тел запросов
+        session = AiohttpSession(
+            json_loads=orjson.loads,
+            json_dumps=lambda obj: orjson.dumps(obj).decode(),
+        )
+        self.bot = Bot(token=Config.BOT_TOKEN, session=session)
+        self.dp = Dispatcher(storage=self._create_fsm_storage())
         self.scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
         self.pool = None
         self.db_log_handler: Optional[DatabaseLogHandler] = None
+        self._objects_listener: Optional[asyncpg.Connection] = None
+        self._objects_reconnect_task: Optional[asyncio.Task] = None
+        self._migrated = False
+        self._schema: Optional[FrozenSet[Tuple[str, str]]] = None
         self._holiday_cache: Dict[int, holidays.HolidayBase] = {}
+        self._objects_cache: Optional[Dict[int, asyncpg.Record]] = None
+        self._objects_geo: Optional[Tuple[List[asyncpg.Record], np.ndarray, np.ndarray, np.ndarray]] = None
+        self._objects_loaded_at = 0.0
+        # Права одобренных сотрудников: проверяются почти в каждом обработчике
+        self._employees_cache: TTLCache = TTLCache(maxsize=1024, ttl=Config.EMPLOYEES_CACHE_TTL)
+        # Вариантов главного меню всего четыре — собираем их один раз
+        self._main_keyboards: Dict[Tuple[bool, bool], ReplyKeyboardMarkup] = {
+            (is_admin, show_remove_sick): self._build_main_keyboard(is_admin, show_remove_sick)
+            for is_admin in (False, True)
+            for show_remove_sick in (False, True)
+        }
+        # Ограничение параллельных рассылок (лимит Telegram ~30 сообщений/с)
+        self._send_limit = asyncio.Semaphore(30)
+        # Клавиатура повторной отправки геолокации не зависит от пользователя
+        self._location_retry_keyboard = ReplyKeyboardMarkup(
+            keyboard=[
+                [KeyboardButton(text="Отправить геолокацию", request_location=True)],
+                [KeyboardButton(text="Не получилось отметить — я на объекте")],
+                [KeyboardButton(text="Отмена")],
+            ],
+            resize_keyboard=True,
+        )
+        # Админ-команды с точным совпадением callback_data: словарь вместо цепочки elif
+        self._admin_routes: Dict[str, Callable[[types.CallbackQuery, FSMContext], Awaitable[None]]] = {
+            "admin_send": lambda cb, st: self.send_timesheet_email(cb),
+            "admin_today_checkins": lambda cb, st: self.show_today_checkins(cb),
+            "admin_employees": lambda cb, st: self.show_employees(cb),
+            "admin_add_employee": lambda cb, st: self.start_employee_input(cb, st, action="add"),
+            "admin_edit_employee": lambda cb, st: self.choose_employee_for_action(cb, "edit"),
+            "admin_delete_employee": lambda cb, st: self.choose_employee_for_action(cb, "delete"),
+            "admin_objects": lambda cb, st: self.show_objects_admin(cb),
+            "admin_add_object": lambda cb, st: self.start_object_input(cb, st, action="add"),
+            "admin_edit_object": lambda cb, st: self.choose_object_for_action(cb, "edit"),
+            "admin_delete_object": lambda cb, st: self.choose_object_for_action(cb, "delete"),
+            "admin_stats": lambda cb, st: self.show_stats(cb),
+            "admin_export_logs": lambda cb, st: self.send_action_log(cb),
+            "admin_manual_requests": lambda cb, st: self.show_manual_requests(cb),
+        }
         self.register_handlers()
 
+    def _create_fsm_storage(self):
+        """Хранилище FSM: Redis, если задан REDIS_URL (состояния переживают перезапуск), иначе память.
+
+        Бот рассчитан на один процесс: polling по одному токену и планировщик
+        напоминаний нельзя запускать в нескольких экземплярах одновременно.
+        """
+        if Config.REDIS_URL:
+            from aiogram.fsm.storage.redis import RedisStorage
+            logger.info("FSM-состояния хранятся в Redis")
+            return RedisStorage.from_url(Config.REDIS_URL)
+        return MemoryStorage()
+
     async def init_db(self):
         """Инициализация БД"""
         try:
-            self.pool = await asyncpg.create_pool(Config.DATABASE_URL)
+            # Явные размеры пула и кэша подготовленных выражений: asyncpg кэширует
+            # план каждого запроса на соединении, поэтому соединения не должны
+            # закрываться слишком часто, иначе кэш теряется
+            self.pool = await asyncpg.create_pool(
+                Config.DATABASE_URL,
+                min_size=Config.DB_POOL_MIN,
+                max_size=Config.DB_POOL_MAX,
+                statement_cache_size=Config.DB_STATEMENT_CACHE_SIZE,
+                max_inactive_connection_lifetime=Config.DB_MAX_INACTIVE_LIFETIME,
+                command_timeout=Config.DB_COMMAND_TIMEOUT,
+                # JIT на коротких OLTP-запросах только добавляет задержку
+                server_settings={'jit': 'off'},
+            )
 
             async with self.pool.acquire() as conn:
                 # Таблица сотрудников - ДОБАВЛЕНА КОЛОНКА position
@@ -145,56 +295,10 @@ class WorkTimeBot:
                     )
                 ''')
 
-                await conn.execute('''
-                    CREATE TABLE IF NOT EXISTS log_entries (
-                        id SERIAL PRIMARY KEY,
-                        created_at TIMESTAMP DEFAULT NOW(),
-                        logger VARCHAR(255),
-                        level VARCHAR(50),
-                        message TEXT
-                    )
-                ''')
-
-                await conn.execute('''
-                    CREATE TABLE IF NOT EXISTS location_audit (
-                        id SERIAL PRIMARY KEY,
-                        employee_id INTEGER REFERENCES employees(id),
-                        object_id INTEGER REFERENCES objects(id),
-                        action VARCHAR(20),
-                        latitude DECIMAL(10, 8),
-                        longitude DECIMAL(11, 8),
-                        distance INTEGER,
-                        accuracy DECIMAL(8, 2),
-                        message_time TIMESTAMP,
-                        is_suspicious BOOLEAN DEFAULT FALSE,
-                        reason TEXT,
-                        created_at TIMESTAMP DEFAULT NOW()
-                    )
-                ''')
-
-                await conn.execute('''
-                    CREATE TABLE IF NOT EXISTS manual_presence_requests (
-                        id SERIAL PRIMARY KEY,
-                        employee_id INTEGER REFERENCES employees(id),
-                        object_id INTEGER REFERENCES objects(id),
-                        action VARCHAR(20),
-                        requested_at TIMESTAMP DEFAULT NOW(),
-                        status VARCHAR(20) DEFAULT 'pending',
-                        note TEXT,
-                        photo_file_id TEXT,
-                        latitude DECIMAL(10, 8),
-                        longitude DECIMAL(11, 8),
-                        distance INTEGER,
-                        log_id INTEGER,
-                        admin_id INTEGER,
-                        processed_at TIMESTAMP,
-                        decision_note TEXT,
-                        created_at TIMESTAMP DEFAULT NOW()
-                    )
-                ''')
-
-                # Гарантируем наличие критичных столбцов для обратной совместимости
+                # Журнал, аудит геолокаций, ручные отметки и критичные столбцы
                 await self.safe_migration()
+                await self.ensure_indexes(conn)
+                await self.ensure_objects_notify(conn)
 
                 # Добавляем администратора БЕЗ ДОЛЖНОСТИ (чтобы не попадал в табель)
                 await conn.execute('''
@@ -207,34 +311,158 @@ class WorkTimeBot:
 
                 self.attach_db_logger()
 
-                logger.info("База данных инициализирована")
+            await self.listen_objects_changes()
+            logger.info("База данных инициализирована")
 
         except Exception as e:
             logger.error(f"Ошибка при инициализации БД: {e}")
             raise
 
+    async def _load_schema(self, conn: asyncpg.Connection) -> FrozenSet[Tuple[str, str]]:
+        """Снимок столбцов схемы public: пары (таблица, столбец), читается один раз"""
+        if self._schema is None:
+            rows = await conn.fetch(
+                "SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = 'public'"
+            )
+            self._schema = frozenset((row['table_name'], row['column_name']) for row in rows)
+        return self._schema
+
     async def ensure_column(self, conn: asyncpg.Connection, table: str, column: str, definition: str):
         """Добавляет столбец, если его нет (для миграций без простоя)"""
+        key = (table, column.lower())
+        if key in await self._load_schema(conn):
+            return
         try:
             column_exists = await conn.fetchval(
                 """
 @@ -213,401 +261,548 @@ class WorkTimeBot:
                 logger.error(f"Критическая ошибка добавления столбца: {err2}")
                 raise
+        self._schema = self._schema | {key}
 
     async def ensure_position_columns(self, conn: asyncpg.Connection):
         """Гарантирует наличие столбца position в ключевых таблицах."""
-        await conn.execute("CREATE TABLE IF NOT EXISTS employees (id SERIAL PRIMARY KEY)")
-        await conn.execute("CREATE TABLE IF NOT EXISTS access_requests (id SERIAL PRIMARY KEY)")
+        schema = await self._load_schema(conn)
+        if ("employees", "position") in schema and ("access_requests", "position") in schema:
+            return
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS employees (id SERIAL PRIMARY KEY);"
+            "CREATE TABLE IF NOT EXISTS access_requests (id SERIAL PRIMARY KEY)"
+        )
 
         await self.ensure_column(conn, "employees", "position", "VARCHAR(100)")
         await self.ensure_column(conn, "access_requests", "position", "VARCHAR(100)")
 
+    async def ensure_objects_notify(self, conn: asyncpg.Connection):
+        """Триггер NOTIFY objects_changed на любые изменения таблицы objects"""
+        try:
+            # Триггер создается один раз: без DROP/CREATE на каждом старте
+            # не берем ACCESS EXCLUSIVE блокировку objects при каждом запуске
+            exists = await conn.fetchval(
+                "SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'objects_changed' AND tgrelid = 'objects'::regclass)"
+            )
+            if exists:
+                return
+            await conn.execute('''
+                CREATE OR REPLACE FUNCTION notify_objects_changed() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM pg_notify('objects_changed', '');
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+                CREATE TRIGGER objects_changed
+                AFTER INSERT OR UPDATE OR DELETE ON objects
+                FOR EACH STATEMENT EXECUTE PROCEDURE notify_objects_changed()
+            ''')
+        except Exception as e:
+            # Нет прав на триггеры или триггер успел создать старый экземпляр при перезапуске:
+            # запуск не прерываем, кэш объектов все равно устаревает по OBJECTS_CACHE_TTL
+            logger.error(f"Не удалось создать триггер изменений объектов: {e}")
+
+    async def listen_objects_changes(self):
+        """Сбрасывает кэш объектов по NOTIFY (правки из другого процесса или вручную в БД)"""
+        if self._objects_listener and not self._objects_listener.is_closed():
+            return
+        try:
+            # Отдельное соединение вне пула: LISTEN живет, пока соединение открыто
+            listener = await asyncpg.connect(Config.DATABASE_URL)
+            await listener.add_listener(
+                'objects_changed',
+                lambda *args: self.invalidate_objects(),
+            )
+            listener.add_termination_listener(self._on_objects_listener_lost)
+            self._objects_listener = listener
+        except Exception as e:
+            # Без подписки кэш все равно устаревает по OBJECTS_CACHE_TTL
+            logger.error(f"Не удалось подписаться на изменения объектов: {e}")
+            self._objects_listener = None
+
+    def _on_objects_listener_lost(self, conn: asyncpg.Connection):
+        """Соединение LISTEN оборвалось: сбрасываем кэш и переподключаемся в фоне"""
+        logger.warning("Соединение подписки на изменения объектов потеряно, переподключаемся")
+        self._objects_listener = None
+        # Пока подписки нет, изменения могли пройти мимо
+        self.invalidate_objects()
+        if self._objects_reconnect_task is None or self._objects_reconnect_task.done():
+            self._objects_reconnect_task = asyncio.get_running_loop().create_task(
+                self._reconnect_objects_listener()
+            )
+
+    async def _reconnect_objects_listener(self):
+        """Повторные попытки подписки с нарастающей паузой (до 5 минут)"""
+        delay = 5
+        while self._objects_listener is None:
+            await asyncio.sleep(delay)
+            await self.listen_objects_changes()
+            delay = min(delay * 2, 300)
+
+    async def close_objects_listener(self):
+        """Закрывает соединение подписки при остановке бота"""
+        if self._objects_reconnect_task:
+            self._objects_reconnect_task.cancel()
+            self._objects_reconnect_task = None
+        listener, self._objects_listener = self._objects_listener, None
+        if listener and not listener.is_closed():
+            # Штатное закрытие не должно запускать переподключение
+            listener.remove_termination_listener(self._on_objects_listener_lost)
+            await listener.close()
+
+    async def on_shutdown(self):
+        """Освобождает фоновые соединения при остановке polling"""
+        await self.close_objects_listener()
+        # Журнал закрываем последним, чтобы записи об остановке тоже попали в БД
+        if self.db_log_handler:
+            logging.getLogger().removeHandler(self.db_log_handler)
+            await self.db_log_handler.aclose()
+            self.db_log_handler = None
+
+    async def ensure_indexes(self, conn: asyncpg.Connection):
+        """Индексы под горячие выборки"""
+        # Все индексы одним запросом
+        await conn.execute('''
+            -- Отчеты и дневная статистика фильтруют по дате
+            CREATE INDEX IF NOT EXISTS idx_time_logs_date ON time_logs (date);
+            -- Поиск незакрытой смены сотрудника (уход, напоминания, авто-уход)
+            CREATE INDEX IF NOT EXISTS idx_time_logs_open ON time_logs (employee_id) WHERE check_out IS NULL;
+            -- Самый частый запрос: записи сотрудника за конкретный день
+            CREATE INDEX IF NOT EXISTS idx_time_logs_employee_date ON time_logs (employee_id, date);
+            -- Авто-уход и напоминания: открытые смены за день
+            CREATE INDEX IF NOT EXISTS idx_time_logs_open_by_date ON time_logs (date)
+            WHERE check_in IS NOT NULL AND check_out IS NULL;
+            -- Очередь ручных подтверждений в админке: только ожидающие, новые сверху
+            CREATE INDEX IF NOT EXISTS idx_manual_requests_pending ON manual_presence_requests (id DESC)
+            WHERE status = 'pending'
+        ''')
+
     async def safe_migration(self):
         """Безопасная миграция БД при старте"""
+        # Схема не меняется во время работы процесса — достаточно одного прогона
+        if self._migrated:
+            return
         try:
             async with self.pool.acquire() as conn:
                 await self.ensure_position_columns(conn)
+                # Все CREATE TABLE одним запросом: один round trip вместо трех
                 await conn.execute('''
                     CREATE TABLE IF NOT EXISTS log_entries (
                         id SERIAL PRIMARY KEY,
@@ -242,9 +470,7 @@ class WorkTimeBot:
                         logger VARCHAR(255),
                         level VARCHAR(50),
                         message TEXT
-                    )
-                ''')
-                await conn.execute('''
+                    );
                     CREATE TABLE IF NOT EXISTS location_audit (
                         id SERIAL PRIMARY KEY,
                         employee_id INTEGER REFERENCES employees(id),
@@ -258,9 +484,7 @@ class WorkTimeBot:
                         is_suspicious BOOLEAN DEFAULT FALSE,
                         reason TEXT,
                         created_at TIMESTAMP DEFAULT NOW()
-                    )
-                ''')
-                await conn.execute('''
+                    );
                     CREATE TABLE IF NOT EXISTS manual_presence_requests (
                         id SERIAL PRIMARY KEY,
                         employee_id INTEGER REFERENCES employees(id),
@@ -281,6 +505,7 @@ class WorkTimeBot:
                     )
                 ''')
 
+            self._migrated = True
             logger.info("Миграция БД завершена успешно")
         except Exception as e:
             logger.error(f"Ошибка миграции БД: {e}")
@@ -298,7 +523,10 @@ class WorkTimeBot:
 
     def moscow_now(self) -> datetime:
         """Возвращает текущее московское время с TZ-информацией"""
-        return datetime.now(MOSCOW_TZ)
+        now = _update_now.get()
+        if now is None:
+            return datetime.now(MOSCOW_TZ)
+        return now
 
     def moscow_now_naive(self) -> datetime:
         """Возвращает текущее московское время без TZ (для хранения в БД без таймзоны)"""
@@ -314,6 +542,58 @@ class WorkTimeBot:
             self._holiday_cache[year] = holidays.Russia(years=[year])
         return self._holiday_cache[year]
 
+    async def get_objects_cached(self) -> List[asyncpg.Record]:
+        """Список объектов из кэша (объекты меняются только через админку)"""
+        # Короткий TTL страхует от правок объектов мимо бота (вручную в БД)
+        now = asyncio.get_running_loop().time()
+        if self._objects_cache is not None and now - self._objects_loaded_at > Config.OBJECTS_CACHE_TTL:
+            self.invalidate_objects()
+        if self._objects_cache is None:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(
+                    'SELECT id, name, address, latitude, longitude, radius FROM objects ORDER BY name'
+                )
+            self._objects_cache = {row['id']: row for row in rows}
+
+            # Координаты в радианах считаем один раз на загрузку кэша
+            geo_rows = [row for row in rows if row['latitude'] and row['longitude']]
+            lats_rad = np.radians(np.array([float(row['latitude']) for row in geo_rows], dtype=float))
+            lons_rad = np.radians(np.array([float(row['longitude']) for row in geo_rows], dtype=float))
+            self._objects_geo = (geo_rows, lats_rad, lons_rad, np.cos(lats_rad))
+            self._objects_loaded_at = now
+        return list(self._objects_cache.values())
+
+    async def get_object_cached(self, object_id: int) -> Optional[asyncpg.Record]:
+        """Объект по id из кэша"""
+        await self.get_objects_cached()
+        return self._objects_cache.get(object_id)
+
+    async def nearest_object(self, lat: float, lon: float) -> Tuple[Optional[asyncpg.Record], Optional[float]]:
+        """Ближайший к точке объект с заданными координатами и расстояние до него (м)"""
+        await self.get_objects_cached()
+        geo_rows, lats_rad, lons_rad, cos_lats = self._objects_geo
+        if not geo_rows:
+            return None, None
+        # Для выбора ближайшего хватает плоской (equirectangular) оценки без sin/asin;
+        # точное расстояние по гаверсинусу считаем только для победителя.
+        # Порядок совпадает с точным на расстояниях в несколько километров между объектами;
+        # для далеких объектов и у полюсов это лишь приближение
+        phi = math.radians(lat)
+        # Разницу долгот приводим к [-pi, pi), чтобы точки по разные стороны
+        # меридиана 180° считались близкими
+        dlon = (lons_rad - math.radians(lon) + np.pi) % (2 * np.pi) - np.pi
+        dx = dlon * math.cos(phi)
+        dy = lats_rad - phi
+        idx = int(np.argmin(dx * dx + dy * dy))
+        winner = slice(idx, idx + 1)
+        distance = calculate_distances_vec(lat, lon, lats_rad[winner], lons_rad[winner], cos_lats[winner])[0]
+        return geo_rows[idx], float(distance)
+
+    def invalidate_objects(self):
+        """Сбрасывает кэш объектов после изменений в админке"""
+        self._objects_cache = None
+        self._objects_geo = None
+
     def is_working_day(self, target_date: date) -> bool:
         """Проверяет, является ли дата рабочим днем с учетом праздников РФ"""
         return target_date.weekday() < 5 and target_date not in self._get_ru_holidays(target_date.year)
@@ -324,30 +604,40 @@ class WorkTimeBot:
             msg_time = msg_time.replace(tzinfo=timezone.utc)
         return msg_time.astimezone(MOSCOW_TZ)
 
-    async def build_main_keyboard_for_user(self, user_id: int) -> ReplyKeyboardMarkup:
+    async def build_main_keyboard_for_user(
+        self,
+        user_id: int,
+        conn: Optional[asyncpg.Connection] = None,
+    ) -> ReplyKeyboardMarkup:
         """Формирует главное меню с учетом роли и статуса больничного на сегодня"""
-        is_admin = False
-        sick_today = False
+        if conn is None:
+            async with self.pool.acquire() as conn:
+                return await self.build_main_keyboard_for_user(user_id, conn)
 
-        async with self.pool.acquire() as conn:
-            is_admin = bool(await conn.fetchval(
-                'SELECT is_admin FROM employees WHERE telegram_id = $1',
-                user_id,
-            ) or False)
-            sick_today = bool(await conn.fetchval(
-                '''
-                SELECT 1 FROM time_logs
-                WHERE employee_id = (SELECT id FROM employees WHERE telegram_id = $1)
-                  AND date = $2 AND status = 'sick'
-                LIMIT 1
-                ''',
-                user_id,
-                self.moscow_today(),
-            ) or False)
+        # Роль и больничный на сегодня одним запросом
+        row = await conn.fetchrow(
+            '''
+            SELECT e.is_admin,
+                   EXISTS (
+                       SELECT 1 FROM time_logs tl
+                       WHERE tl.employee_id = e.id AND tl.date = $2 AND tl.status = 'sick'
+                   ) AS sick_today
+            FROM employees e
+            WHERE e.telegram_id = $1
+            ''',
+            user_id,
+            self.moscow_today(),
+        )
+        if not row:
+            return self.get_main_keyboard()
 
-        return self.get_main_keyboard(is_admin=is_admin, show_remove_sick=sick_today)
+        return self.get_main_keyboard(is_admin=bool(row['is_admin']), show_remove_sick=row['sick_today'])
      
     def get_main_keyboard(self, is_admin: bool = False, show_remove_sick: bool = False) -> ReplyKeyboardMarkup:
+        """Основное меню с кнопками"""
+        return self._main_keyboards[(bool(is_admin), bool(show_remove_sick))]
+
+    def _build_main_keyboard(self, is_admin: bool, show_remove_sick: bool) -> ReplyKeyboardMarkup:
         """Создает основное меню с кнопками"""
         builder = ReplyKeyboardBuilder()
         
@@ -370,22 +660,27 @@ class WorkTimeBot:
     
     def register_handlers(self):
         """Регистрация обработчиков"""
+        # Единое "сейчас" на время обработки апдейта
+        self.dp.update.outer_middleware(self.update_time_middleware)
+        self.dp.shutdown.register(self.on_shutdown)
+
         # Команды
         self.dp.message.register(self.handle_start, Command("start"))
         self.dp.message.register(self.handle_admin, Command("admin"))
 
-        # Отмена в любом состоянии
-        self.dp.message.register(self.handle_cancel, F.text == "Отмена")
-
-        # Обработчики кнопок меню
-        self.dp.message.register(self.handle_come, F.text == "Пришел")
-        self.dp.message.register(self.handle_leave, F.text == "Ушел")
-        self.dp.message.register(self.handle_sick_btn, F.text == "Болел")
-        self.dp.message.register(self.handle_sick_clear, F.text == "Снять больничный")
-        self.dp.message.register(self.handle_manual_presence, F.text == "Не получилось отметить — я на объекте")
-        self.dp.message.register(self.handle_select_object_btn, F.text == "Выбрать объект")
-        self.dp.message.register(self.handle_stats_btn, F.text == "Статистика")
-        self.dp.message.register(self.handle_admin_btn, F.text == "Админ панель")
+        # Кнопки меню и отмена в любом состоянии: один фильтр и выбор по словарю
+        self._text_routes = {
+            "Отмена": self.handle_cancel,
+            "Пришел": self.handle_come,
+            "Ушел": self.handle_leave,
+            "Болел": self.handle_sick_btn,
+            "Снять больничный": self.handle_sick_clear,
+            "Не получилось отметить — я на объекте": self.handle_manual_presence,
+            "Выбрать объект": self.handle_select_object_btn,
+            "Статистика": self.handle_stats_btn,
+            "Админ панель": self.handle_admin_btn,
+        }
+        self.dp.message.register(self.handle_menu_text, F.text.in_(frozenset(self._text_routes)))
         
         # Геолокация
         self.dp.message.register(self.handle_location, F.location)
@@ -408,29 +703,85 @@ class WorkTimeBot:
             | F.data.startswith("sick_")
             | (F.data == "request_access"),
         )
+        self.dp.callback_query.register(self.handle_manual_decision, ManualRequestCallback.filter())
     
+    async def update_time_middleware(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        """Фиксирует текущее время один раз на апдейт"""
+        token = _update_now.set(datetime.now(MOSCOW_TZ))
+        try:
+            return await handler(event, data)
+        finally:
+            _update_now.reset(token)
+
     # Вспомогательные методы
-    async def check_access(self, user_id: int, need_admin: bool = False) -> bool:
+    async def check_access(
+        self,
+        user_id: int,
+        need_admin: bool = False,
+        conn: Optional[asyncpg.Connection] = None,
+    ) -> bool:
         """Проверка доступа пользователя"""
         if not self.pool:
             return False
-        
-        async with self.pool.acquire() as conn:
-            query = '''
-                SELECT is_approved, is_admin FROM employees 
-                WHERE telegram_id = $1 AND is_active = TRUE
-            '''
-            user = await conn.fetchrow(query, user_id)
-            
-            if not user:
-                return False
-            
-            if need_admin:
-                return user['is_admin'] and user['is_approved']
-            
-            return user['is_approved']
+
+        # Админ-права проверяем по БД: кэш не видит правок мимо бота,
+        # а снятие прав администратора должно действовать сразу
+        user = await self.get_active_employee(user_id, conn, use_cache=not need_admin)
+
+        if not user:
+            return False
+
+        if need_admin:
+            return user['is_admin'] and user['is_approved']
+
+        return user['is_approved']
     
+    async def get_active_employee(
+        self,
+        user_id: int,
+        conn: Optional[asyncpg.Connection] = None,
+        use_cache: bool = True,
+    ) -> Optional[asyncpg.Record]:
+        """Активный сотрудник по telegram_id: id и права одним запросом"""
+        if use_cache:
+            cached = self._employees_cache.get(user_id)
+            if cached is not None:
+                return cached
+
+        if conn is None:
+            async with self.pool.acquire() as conn:
+                return await self.get_active_employee(user_id, conn, use_cache)
+
+        employee = await conn.fetchrow(
+            '''
+            SELECT id, is_approved, is_admin FROM employees
+            WHERE telegram_id = $1 AND is_active = TRUE
+            ''',
+            user_id,
+        )
+        # Кэшируем только одобренных: одобрение заявки видно сразу,
+        # а понижение прав через админку сбрасывает кэш через invalidate_employees
+        if employee and employee['is_approved']:
+            self._employees_cache[user_id] = employee
+        else:
+            # Свежее чтение показало, что доступа больше нет
+            self._employees_cache.pop(user_id, None)
+        return employee
+
+    def invalidate_employees(self):
+        """Сбрасывает кэш прав после изменений сотрудников в админке"""
+        self._employees_cache.clear()
+
     # Основные обработчики
+    async def handle_menu_text(self, message: types.Message, state: FSMContext):
+        """Диспетчер текстовых кнопок меню"""
+        await self._text_routes[message.text](message, state)
+
     async def handle_start(self, message: types.Message, state: FSMContext):
         """Обработка /start"""
         user_id = message.from_user.id
@@ -440,6 +791,8 @@ class WorkTimeBot:
                 SELECT full_name, is_admin, is_approved FROM employees 
                 WHERE telegram_id = $1
             ''', user_id)
+            if user and user['is_approved']:
+                keyboard = await self.build_main_keyboard_for_user(user_id, conn)
         
         if user and user['is_approved']:
             text = f"Добро пожаловать, {user['full_name']}!\n\n"
@@ -447,7 +800,6 @@ class WorkTimeBot:
                 text += "Вы администратор системы.\n"
             text += "Используйте меню ниже для работы с системой."
             
-            keyboard = await self.build_main_keyboard_for_user(user_id)
             await message.answer(text, reply_markup=keyboard)
         else:
             keyboard = InlineKeyboardMarkup(inline_keyboard=[[
@@ -464,32 +816,34 @@ class WorkTimeBot:
         """Обработка кнопки 'Пришел'"""
         user_id = message.from_user.id
 
-        if not await self.check_access(user_id):
-            await message.answer("Доступ запрещен.")
-            return
-
         today = self.moscow_today()
         async with self.pool.acquire() as conn:
-            sick_today = await conn.fetchval(
-                '''
-                SELECT 1 FROM time_logs
-                WHERE employee_id = (SELECT id FROM employees WHERE telegram_id = $1)
-                  AND date = $2 AND status = 'sick'
-                LIMIT 1
-                ''',
-                user_id,
-                today,
-            )
-            existing = await conn.fetchval('''
-                SELECT check_in FROM time_logs
-                WHERE employee_id = (SELECT id FROM employees WHERE telegram_id = $1) AND date = $2
-                LIMIT 1
-            ''', user_id, today)
+            employee = await self.get_active_employee(user_id, conn)
+            has_access = bool(employee and employee['is_approved'])
+            if has_access:
+                # Больничный и приход за день одним запросом
+                day = await conn.fetchrow(
+                    '''
+                    SELECT COALESCE(bool_or(status = 'sick'), FALSE) AS sick_today,
+                           MIN(check_in) AS existing
+                    FROM time_logs
+                    WHERE employee_id = $1 AND date = $2
+                    ''',
+                    employee['id'],
+                    today,
+                )
+                sick_today, existing = day['sick_today'], day['existing']
+                if sick_today:
+                    keyboard = self.get_main_keyboard(is_admin=employee['is_admin'], show_remove_sick=True)
+
+        if not has_access:
+            await message.answer("Доступ запрещен.")
+            return
 
         if sick_today:
             await message.answer(
                 "Нельзя отметить приход в день, когда стоит статус 'Болел'.",
-                reply_markup=await self.build_main_keyboard_for_user(user_id),
+                reply_markup=keyboard,
             )
             return
 
@@ -505,56 +859,55 @@ class WorkTimeBot:
         """Обработка кнопки 'Ушел'"""
         user_id = message.from_user.id
 
-        if not await self.check_access(user_id):
-            await message.answer("Доступ запрещен.")
-            return
-
         today = self.moscow_today()
         async with self.pool.acquire() as conn:
-            sick_today = await conn.fetchval(
-                '''
-                SELECT 1 FROM time_logs
-                WHERE employee_id = (SELECT id FROM employees WHERE telegram_id = $1)
-                  AND date = $2 AND status = 'sick'
-                LIMIT 1
-                ''',
-                user_id,
-                today,
-            )
-            log = await conn.fetchrow('''
-                SELECT id, check_in FROM time_logs
-                WHERE employee_id = (SELECT id FROM employees WHERE telegram_id = $1) AND date = $2
-                AND check_out IS NULL
-                LIMIT 1
-            ''', user_id, today)
+            employee = await self.get_active_employee(user_id, conn)
+            has_access = bool(employee and employee['is_approved'])
+            if has_access:
+                # Больничный и открытая смена за день одним запросом
+                day = await conn.fetchrow(
+                    '''
+                    SELECT COALESCE(bool_or(status = 'sick'), FALSE) AS sick_today,
+                           MIN(id) FILTER (WHERE check_out IS NULL) AS log_id
+                    FROM time_logs
+                    WHERE employee_id = $1 AND date = $2
+                    ''',
+                    employee['id'],
+                    today,
+                )
+                sick_today, log_id = day['sick_today'], day['log_id']
+                if sick_today:
+                    keyboard = self.get_main_keyboard(is_admin=employee['is_admin'], show_remove_sick=True)
+                elif not log_id:
+                    keyboard = self.get_main_keyboard(is_admin=employee['is_admin'])
+
+        if not has_access:
+            await message.answer("Доступ запрещен.")
+            return
 
         if sick_today:
             await message.answer(
                 "Статус 'Болел' отмечен на сегодня. Отметка ухода недоступна.",
-                reply_markup=await self.build_main_keyboard_for_user(user_id),
+                reply_markup=keyboard,
             )
             await state.clear()
             return
 
-        if not log:
+        if not log_id:
             await message.answer(
                 "Сначала отметьте приход.",
-                reply_markup=self.get_main_keyboard(
-                    is_admin=await self.check_access(user_id, need_admin=True)
-                ),
+                reply_markup=keyboard,
             )
             await state.clear()
             return
 
         await state.set_state(Form.waiting_for_location)
-        await state.update_data(action="checkout", log_id=log['id'])
+        await state.update_data(action="checkout", log_id=log_id)
         await self.show_objects(message, state, "checkout")
 
     async def return_to_main_menu(self, message: types.Message, state: FSMContext):
         """Возврат в главное меню"""
-        user_id = message.from_user.id
-        async with self.pool.acquire() as conn:
-            keyboard = await self.build_main_keyboard_for_user(user_id)
+        keyboard = await self.build_main_keyboard_for_user(message.from_user.id)
         await message.answer("Операция отменена", reply_markup=keyboard)
         await state.clear()
     
@@ -562,43 +915,40 @@ class WorkTimeBot:
         """Обработка кнопки 'Болел'"""
         user_id = message.from_user.id
 
-        if not await self.check_access(user_id):
-            await message.answer("Доступ запрещен.")
-            return
-
         today = self.moscow_today()
         async with self.pool.acquire() as conn:
-            working_today = await conn.fetchval(
-                '''
-                SELECT 1 FROM time_logs
-                WHERE employee_id = (SELECT id FROM employees WHERE telegram_id = $1)
-                  AND date = $2 AND check_in IS NOT NULL
-                LIMIT 1
-                ''',
-                user_id,
-                today,
-            )
-            sick_today = await conn.fetchval(
-                '''
-                SELECT 1 FROM time_logs
-                WHERE employee_id = (SELECT id FROM employees WHERE telegram_id = $1)
-                  AND date = $2 AND status = 'sick'
-                LIMIT 1
-                ''',
-                user_id,
-                today,
-            )
+            employee = await self.get_active_employee(user_id, conn)
+            has_access = bool(employee and employee['is_approved'])
+            if has_access:
+                # Приход и больничный за день одним запросом
+                day = await conn.fetchrow(
+                    '''
+                    SELECT COALESCE(bool_or(check_in IS NOT NULL), FALSE) AS working_today,
+                           COALESCE(bool_or(status = 'sick'), FALSE) AS sick_today
+                    FROM time_logs
+                    WHERE employee_id = $1 AND date = $2
+                    ''',
+                    employee['id'],
+                    today,
+                )
+                working_today, sick_today = day['working_today'], day['sick_today']
+                if working_today or sick_today:
+                    keyboard = self.get_main_keyboard(is_admin=employee['is_admin'], show_remove_sick=sick_today)
+
+        if not has_access:
+            await message.answer("Доступ запрещен.")
+            return
 
         if working_today:
             await message.answer(
                 "Нельзя поставить статус 'Болел', пока отмечен приход.",
-                reply_markup=await self.build_main_keyboard_for_user(user_id),
+                reply_markup=keyboard,
             )
             return
         if sick_today:
             await message.answer(
                 "Болничный уже отмечен на сегодня.",
-                reply_markup=await self.build_main_keyboard_for_user(user_id),
+                reply_markup=keyboard,
             )
             return
 
@@ -622,66 +972,59 @@ class WorkTimeBot:
         
         await self.show_objects(message, state, "select")
     
-    async def handle_stats_btn(self, message: types.Message):
+    async def handle_stats_btn(self, message: types.Message, state: FSMContext):
         """Обработка кнопки 'Статистика'"""
         user_id = message.from_user.id
 
-        if not await self.check_access(user_id, need_admin=True):
-            await message.answer("Доступно только администраторам.")
-            return
-        
         today = self.moscow_today()
 
         async with self.pool.acquire() as conn:
-            logs = await conn.fetch(
-                '''
-                SELECT e.full_name, tl.check_in, tl.check_out, tl.hours_worked, tl.date, tl.status,
-                       COALESCE(o.name, 'Не указан') AS object_name
-                FROM time_logs tl
-                JOIN employees e ON tl.employee_id = e.id
-                LEFT JOIN objects o ON tl.object_id = o.id
-                WHERE tl.date = $1 AND e.is_active = TRUE AND e.is_approved = TRUE
-                ORDER BY e.full_name
-                ''',
-                today,
-            )
-            missing_checkins = await conn.fetch(
-                '''
-                SELECT e.full_name
-                FROM employees e
-                WHERE e.is_active = TRUE AND e.is_approved = TRUE
-                  AND NOT EXISTS (
-                      SELECT 1 FROM time_logs tl
-                      WHERE tl.employee_id = e.id AND tl.date = $1 AND tl.check_in IS NOT NULL
-                  )
-                  AND NOT EXISTS (
-                      SELECT 1 FROM time_logs tl
-                      WHERE tl.employee_id = e.id AND tl.date = $1 AND tl.status = 'sick'
-                  )
-                ORDER BY e.full_name
-                ''',
-                today,
-            )
-            missing_checkouts = await conn.fetch(
-                '''
-                SELECT e.full_name
-                FROM time_logs tl
-                JOIN employees e ON tl.employee_id = e.id
-                WHERE tl.date = $1 AND tl.check_in IS NOT NULL AND tl.check_out IS NULL
-                  AND e.is_active = TRUE AND e.is_approved = TRUE
-                ORDER BY e.full_name
-                ''',
-                today,
-            )
+            is_admin = await self.check_access(user_id, need_admin=True, conn=conn)
+            if is_admin:
+                # Все активные сотрудники с их записями за сегодня одним запросом:
+                # из него же выводятся списки не отметивших приход и уход
+                rows = await conn.fetch(
+                    '''
+                    SELECT e.id AS employee_id, e.full_name, tl.id AS log_id,
+                           tl.check_in, tl.check_out, tl.hours_worked, tl.date, tl.status,
+                           COALESCE(o.name, 'Не указан') AS object_name
+                    FROM employees e
+                    LEFT JOIN time_logs tl ON tl.employee_id = e.id AND tl.date = $1
+                    LEFT JOIN objects o ON tl.object_id = o.id
+                    WHERE e.is_active = TRUE AND e.is_approved = TRUE
+                    ORDER BY e.full_name
+                    ''',
+                    today,
+                )
+
+        if not is_admin:
+            await message.answer("Доступно только администраторам.")
+            return
 
-        text = "Статистика за сегодня:\n\n"
+        logs = [row for row in rows if row['log_id'] is not None]
+        present_ids = {
+            row['employee_id'] for row in logs
+            if row['check_in'] is not None or row['status'] == 'sick'
+        }
+        missing_checkins = []
+        seen_ids = set()
+        for row in rows:
+            if row['employee_id'] in present_ids or row['employee_id'] in seen_ids:
+                continue
+            seen_ids.add(row['employee_id'])
+            missing_checkins.append(row)
+        missing_checkouts = [
+            row for row in logs if row['check_in'] is not None and row['check_out'] is None
+        ]
+
+        parts = ["Статистика за сегодня:\n\n"]
 
         if not logs:
-            text += "Нет отметок за сегодня."
+            parts.append("Нет отметок за сегодня.")
         else:
             for log in logs:
                 if log['status'] == 'sick':
-                    text += (
+                    parts.append(
                         f"{log['full_name']}: Больничный, дата {log['date'].strftime('%d.%m.%Y')}, "
                         f"участок {log['object_name']}\n"
                     )
@@ -691,43 +1034,27 @@ class WorkTimeBot:
                 check_out = log['check_out'].strftime('%H:%M') if log['check_out'] else '—'
                 hours = (log['hours_worked'] or 0)
 
-                text += (
+                parts.append(
                     f"{log['full_name']}: приход {check_in}, уход {check_out}, "
                     f"отработано {hours:.1f} ч., дата {log['date'].strftime('%d.%m.%Y')}, "
                     f"участок {log['object_name']}\n"
                 )
 
-        text += "\nНе отметили приход:\n"
-        if not missing_checkins:
-            text += "—\n"
-        else:
-            for row in missing_checkins:
-                text += f"• {row['full_name']}\n"
-
-        text += "\nНе отметили уход:\n"
-        if not missing_checkouts:
-            text += "—"
-        else:
-            for row in missing_checkouts:
-                text += f"• {row['full_name']}\n"
-
-        text += "\nНе отметили приход:\n"
+        parts.append("\nНе отметили приход:\n")
         if not missing_checkins:
-            text += "—\n"
+            parts.append("—\n")
         else:
-            for row in missing_checkins:
-                text += f"• {row['full_name']}\n"
+            parts.extend(f"• {row['full_name']}\n" for row in missing_checkins)
 
-        text += "\nНе отметили уход:\n"
+        parts.append("\nНе отметили уход:\n")
         if not missing_checkouts:
-            text += "—"
+            parts.append("—")
         else:
-            for row in missing_checkouts:
-                text += f"• {row['full_name']}\n"
+            parts.extend(f"• {row['full_name']}\n" for row in missing_checkouts)
 
-        await message.answer(text)
+        await message.answer("".join(parts))
     
-    async def handle_admin_btn(self, message: types.Message):
+    async def handle_admin_btn(self, message: types.Message, state: FSMContext):
         """Обработка кнопки 'Админ панель'"""
         await self.handle_admin(message)
     
@@ -779,30 +1106,10 @@ class WorkTimeBot:
                 await callback.answer("Нет прав", show_alert=True)
                 return
 
-            # Подстраховка: перед любыми админ-действиями проверяем наличие критичных столбцов
-            await self.safe_migration()
 @@ -623,56 +818,68 @@ class WorkTimeBot:
                     await self.generate_timesheet(callback, include_objects=True)
-                elif data == "admin_send":
-                    await self.send_timesheet_email(callback)
-                elif data == "admin_today_checkins":
-                    await self.show_today_checkins(callback)
-                elif data == "admin_employees":
-                    await self.show_employees(callback)
-                elif data == "admin_add_employee":
-                    await self.start_employee_input(callback, state, action="add")
-                elif data == "admin_edit_employee":
-                    await self.choose_employee_for_action(callback, "edit")
-                elif data == "admin_delete_employee":
-                    await self.choose_employee_for_action(callback, "delete")
-                elif data == "admin_objects":
-                    await self.show_objects_admin(callback)
-                elif data == "admin_add_object":
-                    await self.start_object_input(callback, state, action="add")
-                elif data == "admin_edit_object":
-                    await self.choose_object_for_action(callback, "edit")
-                elif data == "admin_delete_object":
-                    await self.choose_object_for_action(callback, "delete")
+                elif data in self._admin_routes:
+                    await self._admin_routes[data](callback, state)
                 elif data.startswith("admin_obj_edit_"):
                     await self.start_object_input(callback, state, action="edit")
                 elif data.startswith("admin_obj_delete_"):
@@ -815,16 +1122,11 @@ class WorkTimeBot:
                     await self.toggle_employee_flag(callback)
                 elif data.startswith("admin_emp_delete_"):
                     await self.delete_employee(callback)
-                elif data == "admin_stats":
-                    await self.show_stats(callback)
-                elif data == "admin_export_logs":
-                    await self.send_action_log(callback)
-                elif data == "admin_manual_requests":
-                    await self.show_manual_requests(callback)
                 elif data.startswith("admin_manual_approve_"):
-                    await self.approve_manual_request(callback)
+                    # Кнопки, отправленные до перехода на ManualRequestCallback
+                    await self.approve_manual_request(callback, int(data.rsplit("_", 1)[1]))
                 elif data.startswith("admin_manual_reject_"):
-                    await self.reject_manual_request(callback)
+                    await self.reject_manual_request(callback, int(data.rsplit("_", 1)[1]))
                 else:
                     await callback.answer("Неизвестная команда", show_alert=True)
                     return
@@ -871,27 +1173,21 @@ class WorkTimeBot:
                 new_is_active = is_active if len(parts) > 4 else current['is_active']
                 new_is_approved = is_approved if len(parts) > 5 else current['is_approved']
 
-                await conn.execute('''
+                updated = await conn.fetchrow('''
                     UPDATE employees
                     SET full_name = $1, position = $2, telegram_id = $3,
                         is_admin = $4, is_active = $5, is_approved = $6
                     WHERE id = $7
+                    RETURNING id, full_name, position, telegram_id, is_admin, is_active, is_approved
                     ''', new_full_name, new_position, new_telegram_id, new_is_admin, new_is_active, new_is_approved, target_employee_id)
-
-                updated = await conn.fetchrow(
-                    '''
-                    SELECT id, full_name, position, telegram_id, is_admin, is_active, is_approved
-                    FROM employees WHERE id = $1
-                    ''',
-                    target_employee_id,
-                )
+                self.invalidate_employees()
                 summary = self._format_employee_summary(updated) if updated else "Данные сотрудника обновлены"
                 await message.answer(
                     f"Данные сотрудника обновлены:\n{summary}",
                     reply_markup=await self.build_main_keyboard_for_user(message.from_user.id),
                 )
             else:
-                await conn.execute('''
+                saved = await conn.fetchrow('''
                     INSERT INTO employees (full_name, position, telegram_id, is_admin, is_active, is_approved)
                     VALUES ($1, $2, $3, $4, $5, $6)
                     ON CONFLICT (telegram_id) DO UPDATE SET
@@ -900,15 +1196,9 @@ class WorkTimeBot:
                         is_admin = EXCLUDED.is_admin,
                         is_active = EXCLUDED.is_active,
                         is_approved = EXCLUDED.is_approved
+                    RETURNING id, full_name, position, telegram_id, is_admin, is_active, is_approved
                 ''', full_name, position, telegram_id, is_admin, is_active, is_approved)
-
-                saved = await conn.fetchrow(
-                    '''
-                    SELECT id, full_name, position, telegram_id, is_admin, is_active, is_approved
-                    FROM employees WHERE telegram_id = $1
-                    ''',
-                    telegram_id,
-                )
+                self.invalidate_employees()
                 summary = self._format_employee_summary(saved) if saved else "Сотрудник сохранен"
                 await message.answer(f"Сотрудник сохранен:\n{summary}", reply_markup=self.get_main_keyboard())
 
@@ -924,29 +1214,33 @@ class WorkTimeBot:
         async with self.pool.acquire() as conn:
             working_today = await conn.fetchval(
                 '''
-                SELECT 1 FROM time_logs
-                WHERE employee_id = (SELECT id FROM employees WHERE telegram_id = $1)
-                  AND date = $2 AND check_in IS NOT NULL
+                SELECT 1 FROM time_logs tl
+                JOIN employees e ON tl.employee_id = e.id
+                WHERE e.telegram_id = $1
+                  AND tl.date = $2 AND tl.check_in IS NOT NULL
                 LIMIT 1
                 ''',
                 user_id,
                 today,
             )
-            if working_today:
-                await message.answer(
-                    "Приход уже отмечен, больничный недоступен.",
-                    reply_markup=await self.build_main_keyboard_for_user(user_id),
-                )
-                await state.clear()
-                return
-            await conn.execute('''
-                INSERT INTO time_logs (employee_id, date, status, notes)
-                VALUES ((SELECT id FROM employees WHERE telegram_id = $1), $2, 'sick', $3)
-            ''', user_id, today, reason)
-        
+            if not working_today:
+                await conn.execute('''
+                    INSERT INTO time_logs (employee_id, date, status, notes)
+                    VALUES ((SELECT id FROM employees WHERE telegram_id = $1), $2, 'sick', $3)
+                ''', user_id, today, reason)
+            keyboard = await self.build_main_keyboard_for_user(user_id, conn)
+
+        if working_today:
+            await message.answer(
+                "Приход уже отмечен, больничный недоступен.",
+                reply_markup=keyboard,
+            )
+            await state.clear()
+            return
+
         await message.answer(
             f"Больничный отмечен\nПричина: {reason if reason else 'не указана'}",
-            reply_markup=await self.build_main_keyboard_for_user(user_id),
+            reply_markup=keyboard,
         )
         await state.clear()
 
@@ -967,8 +1261,7 @@ class WorkTimeBot:
 
     async def choose_object_for_action(self, callback: types.CallbackQuery, action: str):
         """Выбор объекта для редактирования/удаления"""
-        async with self.pool.acquire() as conn:
-            objects = await conn.fetch('SELECT id, name FROM objects ORDER BY name')
+        objects = await self.get_objects_cached()
 
         if not objects:
             await callback.message.answer("Список объектов пуст")
@@ -988,9 +1281,10 @@ class WorkTimeBot:
             await callback.message.answer("Не удалось определить объект")
             return
 
-        async with self.pool.acquire() as conn:
+        async with self.pool.acquire() as conn, conn.transaction():
             await conn.execute('UPDATE time_logs SET object_id = NULL WHERE object_id = $1', obj_id)
             deleted = await conn.execute('DELETE FROM objects WHERE id = $1', obj_id)
+        self.invalidate_objects()
 
         await callback.message.answer(f"Объект удален ({deleted})")
 
@@ -1145,6 +1439,7 @@ class WorkTimeBot:
                 new_value,
                 emp_id,
             )
+        self.invalidate_employees()
 
         await self.show_employee_card(callback)
 
@@ -1169,6 +1464,7 @@ class WorkTimeBot:
                 ''',
                 emp_id,
             )
+        self.invalidate_employees()
 
         await callback.message.answer("Сотрудник деактивирован")
     
@@ -1177,6 +1473,7 @@ class WorkTimeBot:
                     SET name = $1, address = $2, latitude = $3, longitude = $4, radius = $5
                     WHERE id = $6
                 ''', updated_name, updated_address, updated_lat, updated_lon, updated_radius, target_object_id)
+                self.invalidate_objects()
 
                 await message.answer(
                     f"Объект обновлен: {updated_name}",
@@ -1187,6 +1484,7 @@ class WorkTimeBot:
                     INSERT INTO objects (name, address, latitude, longitude, radius)
                     VALUES ($1, $2, $3, $4, $5)
                 ''', name, address, lat, lon, radius)
+                self.invalidate_objects()
 
                 await message.answer(f"Объект добавлен: {name}",
                                    reply_markup=self.get_main_keyboard())
@@ -1207,42 +1505,26 @@ class WorkTimeBot:
             await state.clear()
             return
 
-        async with self.pool.acquire() as conn:
-            target_object = None
-            if selected_object_id:
-                target_object = await conn.fetchrow(
-                    'SELECT id, name, latitude, longitude, radius FROM objects WHERE id = $1',
-                    selected_object_id,
+        target_object = None
+        distance = None
+        if selected_object_id:
+            target_object = await self.get_object_cached(selected_object_id)
+            if target_object and target_object['latitude'] and target_object['longitude']:
+                distance = calculate_distance(
+                    location.latitude,
+                    location.longitude,
+                    target_object['latitude'],
+                    target_object['longitude'],
                 )
-            else:
-                objects = await conn.fetch('SELECT id, name, latitude, longitude, radius FROM objects')
-                nearest = None
-                min_dist = float('inf')
-                for obj in objects:
-                    if obj['latitude'] and obj['longitude']:
-                        dist = calculate_distance(
-                            location.latitude, location.longitude,
-                            obj['latitude'], obj['longitude']
-                        )
-                        if dist < min_dist:
-                            min_dist = dist
-                            nearest = obj
-                target_object = nearest
+        else:
+            # Расстояние до ближайшего уже посчитано по кэшированным радианам
+            target_object, distance = await self.nearest_object(location.latitude, location.longitude)
 
         if not target_object:
             await self.show_objects(message, state, action)
             await state.update_data(lat=location.latitude, lon=location.longitude)
             return
 
-        distance = None
-        if target_object['latitude'] and target_object['longitude']:
-            distance = calculate_distance(
-                location.latitude,
-                location.longitude,
-                target_object['latitude'],
-                target_object['longitude'],
-            )
-
         accuracy = location.horizontal_accuracy
         suspicious_reasons = []
         age_seconds = (self.moscow_now() - message_time_msk).total_seconds()
@@ -1282,14 +1564,7 @@ class WorkTimeBot:
                 "Геолокация выглядит недостоверной. Отправьте актуальную точку через кнопку "
                 "«Отправить геолокацию» и убедитесь, что GPS включен.\n"
                 "Если отметка не проходит, используйте кнопку «Не получилось отметить — я на объекте».",
-                reply_markup=ReplyKeyboardMarkup(
-                    keyboard=[
-                        [KeyboardButton(text="Отправить геолокацию", request_location=True)],
-                        [KeyboardButton(text="Не получилось отметить — я на объекте")],
-                        [KeyboardButton(text="Отмена")],
-                    ],
-                    resize_keyboard=True,
-                ),
+                reply_markup=self._location_retry_keyboard,
             )
             await state.update_data(selected_object_id=target_object['id'])
             await state.set_state(Form.waiting_for_location)
@@ -1312,14 +1587,7 @@ class WorkTimeBot:
             )
             await message.answer(
                 f"Вы находитесь дальше {Config.LOCATION_RADIUS} м от выбранного объекта. Подойдите ближе и отправьте геолокацию еще раз.",
-                reply_markup=ReplyKeyboardMarkup(
-                    keyboard=[
-                        [KeyboardButton(text="Отправить геолокацию", request_location=True)],
-                        [KeyboardButton(text="Не получилось отметить — я на объекте")],
-                        [KeyboardButton(text="Отмена")],
-                    ],
-                    resize_keyboard=True,
-                ),
+                reply_markup=self._location_retry_keyboard,
             )
             await self.log_location_attempt(
                 user_id=message.from_user.id,
@@ -1543,14 +1811,27 @@ class WorkTimeBot:
             extra_note += f"\nФото: {photo_id}"
 
         if action == "checkin":
+            # Сотрудник определяется один раз; при конфликте возвращается уже существующая запись дня
             async with self.pool.acquire() as conn:
-                await conn.execute(
+                new_log_id = await conn.fetchval(
                     '''
-                    INSERT INTO time_logs (
-                        employee_id, object_id, date, check_in, check_in_lat, check_in_lon, status, notes
+                    WITH emp AS (
+                        SELECT id FROM employees WHERE telegram_id = $1
+                    ), inserted AS (
+                        INSERT INTO time_logs (
+                            employee_id, object_id, date, check_in, check_in_lat, check_in_lon, status, notes
+                        )
+                        SELECT emp.id, $2, $3, $4, $5, $6, $7, $8 FROM emp
+                        ON CONFLICT DO NOTHING
+                        RETURNING id
                     )
-                    VALUES ((SELECT id FROM employees WHERE telegram_id = $1), $2, $3, $4, $5, $6, $7, $8)
-                    ON CONFLICT DO NOTHING
+                    SELECT id FROM inserted
+                    UNION ALL
+                    SELECT tl.id FROM time_logs tl
+                    JOIN emp ON tl.employee_id = emp.id
+                    WHERE tl.date = $3
+                    ORDER BY id DESC
+                    LIMIT 1
                     ''',
                     user_id,
                     object_id,
@@ -1561,28 +1842,18 @@ class WorkTimeBot:
                     status_label,
                     extra_note,
                 )
-                new_log_id = await conn.fetchval(
-                    '''
-                    SELECT id FROM time_logs
-                    WHERE employee_id = (SELECT id FROM employees WHERE telegram_id = $1)
-                      AND date = $2
-                    ORDER BY id DESC
-                    LIMIT 1
-                    ''',
-                    user_id,
-                    requested_at.date(),
-                )
                 return new_log_id
 
         elif action == "checkout":
-            async with self.pool.acquire() as conn:
+            async with self.pool.acquire() as conn, conn.transaction():
                 if not log_id:
                     log_id = await conn.fetchval(
                         '''
-                        SELECT id FROM time_logs
-                        WHERE employee_id = (SELECT id FROM employees WHERE telegram_id = $1)
-                          AND date = $2 AND check_out IS NULL
-                        ORDER BY id DESC LIMIT 1
+                        SELECT tl.id FROM time_logs tl
+                        JOIN employees e ON tl.employee_id = e.id
+                        WHERE e.telegram_id = $1
+                          AND tl.date = $2 AND tl.check_out IS NULL
+                        ORDER BY tl.id DESC LIMIT 1
                         ''',
                         user_id,
                         requested_at.date(),
@@ -1591,10 +1862,7 @@ class WorkTimeBot:
                     return None
 
                 check_in = await conn.fetchval('SELECT check_in FROM time_logs WHERE id = $1', log_id)
-                hours = 0
-                if check_in:
-                    hours = (requested_at - check_in).total_seconds() / 3600
-                hours = min(max(0, math.ceil(hours)), Config.MAX_WORK_HOURS)
+                hours = calculate_hours(check_in, requested_at)
 
                 await conn.execute(
                     '''
@@ -1685,12 +1953,19 @@ class WorkTimeBot:
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=[
                 [
-                    InlineKeyboardButton(text="Одобрить", callback_data=f"admin_manual_approve_{req['id']}"),
-                    InlineKeyboardButton(text="Отклонить", callback_data=f"admin_manual_reject_{req['id']}"),
+                    InlineKeyboardButton(
+                        text="Одобрить",
+                        callback_data=ManualRequestCallback(action="approve", req_id=req['id']).pack(),
+                    ),
+                    InlineKeyboardButton(
+                        text="Отклонить",
+                        callback_data=ManualRequestCallback(action="reject", req_id=req['id']).pack(),
+                    ),
                 ]
             ]
         )
-        for admin_id in Config.ADMIN_IDS:
+
+        async def send_to_admin(admin_id: int):
             try:
                 if req['photo_file_id']:
                     await self.bot.send_photo(
@@ -1704,6 +1979,9 @@ class WorkTimeBot:
             except Exception as err:
                 logger.error(f"Не удалось отправить запрос {req_id} администратору {admin_id}: {err}")
 
+        # Рассылаем всем администраторам параллельно
+        await asyncio.gather(*(send_to_admin(admin_id) for admin_id in Config.ADMIN_IDS))
+
     async def show_manual_requests(self, callback: types.CallbackQuery):
         """Показать ожидающие ручные подтверждения"""
         async with self.pool.acquire() as conn:
@@ -1734,8 +2012,14 @@ class WorkTimeBot:
             keyboard = InlineKeyboardMarkup(
                 inline_keyboard=[
                     [
-                        InlineKeyboardButton(text="Одобрить", callback_data=f"admin_manual_approve_{row['id']}"),
-                        InlineKeyboardButton(text="Отклонить", callback_data=f"admin_manual_reject_{row['id']}"),
+                        InlineKeyboardButton(
+                            text="Одобрить",
+                            callback_data=ManualRequestCallback(action="approve", req_id=row['id']).pack(),
+                        ),
+                        InlineKeyboardButton(
+                            text="Отклонить",
+                            callback_data=ManualRequestCallback(action="reject", req_id=row['id']).pack(),
+                        ),
                     ]
                 ]
             )
@@ -1744,14 +2028,29 @@ class WorkTimeBot:
             else:
                 await callback.message.answer(text, reply_markup=keyboard)
 
-    async def approve_manual_request(self, callback: types.CallbackQuery):
-        """Одобрить ручную отметку"""
-        try:
-            req_id = int(callback.data.rsplit("_", 1)[1])
-        except Exception:
-            await callback.answer("Некорректный запрос", show_alert=True)
+    async def handle_manual_decision(self, callback: types.CallbackQuery, callback_data: ManualRequestCallback):
+        """Обработка кнопок одобрения/отклонения ручной отметки"""
+        if not await self.check_access(callback.from_user.id, need_admin=True):
+            await callback.answer("Нет прав", show_alert=True)
             return
 
+        try:
+            if callback_data.action == "approve":
+                await self.approve_manual_request(callback, callback_data.req_id)
+            elif callback_data.action == "reject":
+                await self.reject_manual_request(callback, callback_data.req_id)
+            else:
+                await callback.answer("Некорректный запрос", show_alert=True)
+        except Exception as decision_error:
+            logger.error(f"Ошибка обработки ручной отметки {callback_data.req_id}: {decision_error}")
+            try:
+                await callback.answer("Ошибка обработки запроса. Попробуйте позже.", show_alert=True)
+            except Exception:
+                # Callback уже мог быть отвечен до ошибки — сообщаем в чат
+                await callback.message.answer("Произошла ошибка при обработке запроса администратора. Попробуйте позже.")
+
+    async def approve_manual_request(self, callback: types.CallbackQuery, req_id: int):
+        """Одобрить ручную отметку"""
         async with self.pool.acquire() as conn:
             req = await conn.fetchrow(
                 '''
@@ -1769,6 +2068,7 @@ class WorkTimeBot:
             await callback.answer("Уже обработано", show_alert=True)
             return
 
+        now = self.moscow_now_naive()
         log_id = await self._apply_manual_time(
             user_id=req['telegram_id'],
             object_id=req['object_id'],
@@ -1776,7 +2076,7 @@ class WorkTimeBot:
             log_id=req['log_id'],
             note=req['note'] or "",
             photo_id=req['photo_file_id'] or "",
-            requested_at=req['requested_at'] or self.moscow_now_naive(),
+            requested_at=req['requested_at'] or now,
             lat=float(req['latitude']) if req['latitude'] is not None else None,
             lon=float(req['longitude']) if req['longitude'] is not None else None,
             distance=float(req['distance']) if req['distance'] is not None else None,
@@ -1791,7 +2091,7 @@ class WorkTimeBot:
                 WHERE id = $4
                 ''',
                 callback.from_user.id,
-                self.moscow_now_naive(),
+                now,
                 log_id,
                 req_id,
             )
@@ -1806,14 +2106,8 @@ class WorkTimeBot:
         except Exception as err:
             logger.error(f"Не удалось уведомить пользователя о одобрении {req_id}: {err}")
 
-    async def reject_manual_request(self, callback: types.CallbackQuery):
+    async def reject_manual_request(self, callback: types.CallbackQuery, req_id: int):
         """Отклонить ручную отметку"""
-        try:
-            req_id = int(callback.data.rsplit("_", 1)[1])
-        except Exception:
-            await callback.answer("Некорректный запрос", show_alert=True)
-            return
-
         async with self.pool.acquire() as conn:
             req = await conn.fetchrow(
                 '''
@@ -1870,10 +2164,15 @@ class WorkTimeBot:
             status = 'late'
 
         async with self.pool.acquire() as conn:
-            await conn.execute(
+            # Вставка и роль сотрудника для клавиатуры за один запрос
+            is_admin = await conn.fetchval(
                 '''
+                WITH emp AS (
+                    SELECT id, is_admin FROM employees WHERE telegram_id = $1
+                )
                 INSERT INTO time_logs (employee_id, object_id, date, check_in, check_in_lat, check_in_lon, status)
-                VALUES ((SELECT id FROM employees WHERE telegram_id = $1), $2, $3, $4, $5, $6, $7)
+                SELECT emp.id, $2, $3, $4, $5, $6, $7 FROM emp
+                RETURNING (SELECT is_admin FROM emp)
                 ''',
                 user_id,
                 obj['id'],
@@ -1883,9 +2182,8 @@ class WorkTimeBot:
                 lon,
                 status,
             )
-            is_admin = await conn.fetchval('SELECT is_admin FROM employees WHERE telegram_id = $1', user_id)
 
-        keyboard = self.get_main_keyboard(is_admin=is_admin)
+        keyboard = self.get_main_keyboard(is_admin=bool(is_admin))
 
         message_text = f"Приход отмечен!\nВремя: {now.strftime('%H:%M')}\nОбъект: {obj['name']}"
         if distance is not None:
@@ -1911,19 +2209,15 @@ class WorkTimeBot:
         log_id: int,
         obj: asyncpg.Record,
         user_id: int,
+        check_in: Optional[datetime],
         lat: Optional[float] = None,
         lon: Optional[float] = None,
     ):
         """Обработка ухода с выбранным объектом"""
         now = self.moscow_now_naive()
+        hours = calculate_hours(check_in, now)
 
         async with self.pool.acquire() as conn:
-            check_in = await conn.fetchval('SELECT check_in FROM time_logs WHERE id = $1', log_id)
-            hours = 0
-            if check_in:
-                hours = (now - check_in).total_seconds() / 3600
-            hours = min(max(0, math.ceil(hours)), Config.MAX_WORK_HOURS)
-
             await conn.execute(
                 '''
                 UPDATE time_logs SET check_out = $1, check_out_lat = $2, check_out_lon = $3,
@@ -1937,12 +2231,11 @@ class WorkTimeBot:
                 log_id,
             )
 
-            is_admin = await conn.fetchval('SELECT is_admin FROM employees WHERE telegram_id = $1', user_id)
-
         keyboard = await self.build_main_keyboard_for_user(user_id)
+        now_hm = now.strftime('%H:%M')
         await self.bot.send_message(
             user_id,
-            f"Уход отмечен!\nВремя: {now.strftime('%H:%M')}\nОбъект: {obj['name']}\nОтработано: {hours} ч.",
+            f"Уход отмечен!\nВремя: {now_hm}\nОбъект: {obj['name']}\nОтработано: {hours} ч.",
             reply_markup=keyboard,
         )
         logger.info(
@@ -1950,7 +2243,7 @@ class WorkTimeBot:
             user_id,
             obj['id'],
             obj['name'],
-            now.strftime('%H:%M'),
+            now_hm,
             hours,
         )
 
@@ -1959,55 +2252,49 @@ class WorkTimeBot:
         if not log_id:
             logger.warning("Не удалось определить запись времени для отметки ухода")
             return
+        # Владелец записи и время прихода одним запросом
         async with self.pool.acquire() as conn:
-            user_id = await conn.fetchval(
+            row = await conn.fetchrow(
                 '''
-                SELECT telegram_id FROM employees WHERE id = (
-                    SELECT employee_id FROM time_logs WHERE id = $1
-                )
+                SELECT e.telegram_id, tl.check_in
+                FROM time_logs tl
+                JOIN employees e ON tl.employee_id = e.id
+                WHERE tl.id = $1
                 ''',
                 log_id,
             )
-        if not user_id:
+        if not row or not row['telegram_id']:
             logger.warning("Не удалось определить пользователя для отметки ухода")
             return
-        await self.process_checkout_manual(log_id, obj, user_id, location.latitude, location.longitude)
+        await self.process_checkout_manual(
+            log_id, obj, row['telegram_id'], row['check_in'], location.latitude, location.longitude
+        )
     
     async def process_checkout_simple(self, user_id: int, log_id: int):
         """Уход без геолокации"""
         now = self.moscow_now_naive()
         
         async with self.pool.acquire() as conn:
-            # Получаем время прихода
-            check_in = await conn.fetchval('SELECT check_in FROM time_logs WHERE id = $1', log_id)
-            
-            if check_in:
-                # Исправленный расчет часов
-                hours = (now - check_in).total_seconds() / 3600
-            else:
-                hours = 0
+            # Часы считаются в самом UPDATE так же, как в calculate_hours
+            hours = await conn.fetchval(f'''
+                UPDATE time_logs
+                SET check_out = $2, hours_worked = {HOURS_WORKED_SQL}
+                WHERE id = $1
+                RETURNING hours_worked::int
+            ''', log_id, now, Config.MAX_WORK_HOURS) or 0
 
-            hours = min(max(0, math.ceil(hours)), Config.MAX_WORK_HOURS)
-            
-            # Обновляем запись
-            await conn.execute('''
-                UPDATE time_logs 
-                SET check_out = $1, hours_worked = $2 
-                WHERE id = $3
-            ''', now, hours, log_id)
-            
-            # Получаем статус администратора
         keyboard = await self.build_main_keyboard_for_user(user_id)
+        now_hm = now.strftime('%H:%M')
         await self.bot.send_message(
             user_id,
-            f"Уход отмечен в {now.strftime('%H:%M')}\nОтработано: {hours} ч.",
+            f"Уход отмечен в {now_hm}\nОтработано: {hours} ч.",
             reply_markup=keyboard
         )
         logger.info(
             "Уход без геолокации: %s запись %s в %s, часов: %.0f",
             user_id,
             log_id,
-            now.strftime('%H:%M'),
+            now_hm,
             hours,
         )
     
@@ -2052,7 +2339,8 @@ class WorkTimeBot:
         today = self.moscow_today()
         year, month = today.year, today.month
         days_in_month = monthrange(year, month)[1]
-        month_label = date(year, month, 1).strftime('%B %Y')
+        month_start = date(year, month, 1)
+        month_label = month_start.strftime('%B %Y')
 
         async with self.pool.acquire() as conn:
             employees = await conn.fetch(
@@ -2071,12 +2359,11 @@ class WorkTimeBot:
                 FROM time_logs tl
                 JOIN employees e ON tl.employee_id = e.id
                 LEFT JOIN objects o ON tl.object_id = o.id
-                WHERE EXTRACT(YEAR FROM tl.date) = $1
-                  AND EXTRACT(MONTH FROM tl.date) = $2
+                WHERE tl.date >= $1 AND tl.date < $2
                 ORDER BY e.full_name, tl.date
                 ''',
-                year,
-                month,
+                month_start,
+                month_start + timedelta(days=days_in_month),
             )
 
             objects = {row['id']: row for row in await conn.fetch('SELECT id, name FROM objects')}
@@ -2112,8 +2399,10 @@ class WorkTimeBot:
                     row.append(days_worked)
                     ws.append(row)
 
+        # Сериализация книги в XML — самая тяжелая часть, выносим ее из event loop
         excel_file = io.BytesIO()
-        wb.save(excel_file)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, wb.save, excel_file)
         excel_file.seek(0)
         return excel_file
 
@@ -2130,9 +2419,16 @@ class WorkTimeBot:
         async with self.pool.acquire() as conn:
             time_logs = await conn.fetch(
                 '''
-                SELECT tl.date, tl.check_in, tl.check_out, tl.hours_worked, tl.status,
-                       tl.check_in_lat, tl.check_in_lon, tl.check_out_lat, tl.check_out_lon,
-                       e.full_name, e.position, e.is_admin, o.name as object_name
+                SELECT to_char(tl.date, 'YYYY-MM-DD') AS date_str,
+                       COALESCE(to_char(tl.check_in, 'HH24:MI:SS'), '') AS check_in_str,
+                       COALESCE(to_char(tl.check_out, 'HH24:MI:SS'), '') AS check_out_str,
+                       COALESCE(tl.hours_worked, 0)::float8 AS hours_worked,
+                       COALESCE(tl.status, '') AS status,
+                       tl.check_in_lat::float8 AS check_in_lat, tl.check_in_lon::float8 AS check_in_lon,
+                       tl.check_out_lat::float8 AS check_out_lat, tl.check_out_lon::float8 AS check_out_lon,
+                       e.full_name, COALESCE(e.position, '') AS position,
+                       CASE WHEN e.is_admin THEN 'Админ' ELSE 'Сотрудник' END AS role,
+                       COALESCE(o.name, '') AS object_name
                 FROM time_logs tl
                 JOIN employees e ON tl.employee_id = e.id
                 LEFT JOIN objects o ON tl.object_id = o.id
@@ -2144,97 +2440,82 @@ class WorkTimeBot:
             )
             location_attempts = await conn.fetch(
                 '''
-                SELECT la.message_time, la.action, la.latitude, la.longitude, la.distance, la.accuracy,
-                       la.is_suspicious, la.reason,
-                       e.full_name, e.position, e.is_admin,
-                       o.name AS object_name
+                SELECT COALESCE(to_char(la.message_time, 'YYYY-MM-DD HH24:MI:SS'), '') AS message_time_str,
+                       COALESCE(la.action, '') AS action,
+                       la.latitude::float8 AS latitude, la.longitude::float8 AS longitude,
+                       la.distance, la.accuracy::float8 AS accuracy,
+                       CASE WHEN la.is_suspicious THEN 'Сомнительно' ELSE 'Ок' END AS mark,
+                       COALESCE(la.reason, '') AS reason,
+                       COALESCE(e.full_name, '') AS full_name, COALESCE(e.position, '') AS position,
+                       CASE WHEN e.is_admin THEN 'Админ' ELSE 'Сотрудник' END AS role,
+                       COALESCE(o.name, '') AS object_name
                 FROM location_audit la
                 LEFT JOIN employees e ON la.employee_id = e.id
                 LEFT JOIN objects o ON la.object_id = o.id
-                WHERE la.message_time::date BETWEEN $1 AND $2
+                WHERE la.message_time >= $1 AND la.message_time < $2
                 ORDER BY la.message_time DESC
                 ''',
-                start_date,
-                end_date,
+                datetime.combine(start_date, time.min),
+                datetime.combine(end_date + timedelta(days=1), time.min),
             )
 
         if not time_logs and not location_attempts:
             return None
 
-        wb = Workbook()
-        ws_actions = wb.active
-        ws_actions.title = "Отметки"
-        ws_actions.append(
-            [
-                "Дата",
-                "Сотрудник",
-                "Должность",
-                "Роль",
-                "Объект",
-                "Статус",
-                "Приход",
-                "Широта прихода",
-                "Долгота прихода",
-                "Уход",
-                "Широта ухода",
-                "Долгота ухода",
-                "Часы",
-            ]
+        # Сборка книги синхронная и тяжелая, не блокируем ею event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self._render_action_log_report, time_logs, location_attempts
         )
 
+    def _render_action_log_report(
+        self,
+        time_logs: List[asyncpg.Record],
+        location_attempts: List[asyncpg.Record],
+    ) -> io.BytesIO:
+        """Собирает xlsx журнала действий (выполняется в пуле потоков)"""
+        # write-only: строки сразу уходят в поток листа, без хранения объектов ячеек
+        wb = Workbook(write_only=True)
+        ws_actions = wb.create_sheet("Отметки")
+        ws_actions.append(ACTION_LOG_HEADERS)
+
+        # Даты, роли и пустые значения уже подготовлены в SQL
         for log in time_logs:
-            role = "Админ" if log['is_admin'] else "Сотрудник"
             ws_actions.append(
                 [
-                    log['date'].strftime("%Y-%m-%d"),
+                    log['date_str'],
                     log['full_name'],
-                    log['position'] or "",
-                    role,
-                    log['object_name'] or "",
-                    log['status'] or "",
-                    log['check_in'].strftime("%H:%M:%S") if log['check_in'] else "",
-                    float(log['check_in_lat']) if log['check_in_lat'] is not None else "",
-                    float(log['check_in_lon']) if log['check_in_lon'] is not None else "",
-                    log['check_out'].strftime("%H:%M:%S") if log['check_out'] else "",
-                    float(log['check_out_lat']) if log['check_out_lat'] is not None else "",
-                    float(log['check_out_lon']) if log['check_out_lon'] is not None else "",
-                    float(log['hours_worked'] or 0),
+                    log['position'],
+                    log['role'],
+                    log['object_name'],
+                    log['status'],
+                    log['check_in_str'],
+                    log['check_in_lat'] if log['check_in_lat'] is not None else "",
+                    log['check_in_lon'] if log['check_in_lon'] is not None else "",
+                    log['check_out_str'],
+                    log['check_out_lat'] if log['check_out_lat'] is not None else "",
+                    log['check_out_lon'] if log['check_out_lon'] is not None else "",
+                    log['hours_worked'],
                 ]
             )
 
         ws_geo = wb.create_sheet("Геолокации")
-        ws_geo.append(
-            [
-                "Время (МСК)",
-                "Сотрудник",
-                "Должность",
-                "Роль",
-                "Действие",
-                "Объект",
-                "Широта",
-                "Долгота",
-                "Расстояние до объекта, м",
-                "Точность, м",
-                "Пометка",
-                "Причина",
-            ]
-        )
+        ws_geo.append(GEO_LOG_HEADERS)
         for attempt in location_attempts:
-            role = "Админ" if attempt['is_admin'] else "Сотрудник"
             ws_geo.append(
                 [
-                    attempt['message_time'].strftime("%Y-%m-%d %H:%M:%S") if attempt['message_time'] else "",
-                    attempt['full_name'] or "",
-                    attempt['position'] or "",
-                    role,
-                    attempt['action'] or "",
-                    attempt['object_name'] or "",
-                    float(attempt['latitude']) if attempt['latitude'] is not None else "",
-                    float(attempt['longitude']) if attempt['longitude'] is not None else "",
+                    attempt['message_time_str'],
+                    attempt['full_name'],
+                    attempt['position'],
+                    attempt['role'],
+                    attempt['action'],
+                    attempt['object_name'],
+                    attempt['latitude'] if attempt['latitude'] is not None else "",
+                    attempt['longitude'] if attempt['longitude'] is not None else "",
                     attempt['distance'] if attempt['distance'] is not None else "",
-                    float(attempt['accuracy']) if attempt['accuracy'] is not None else "",
-                    "Сомнительно" if attempt['is_suspicious'] else "Ок",
-                    attempt['reason'] or "",
+                    attempt['accuracy'] if attempt['accuracy'] is not None else "",
+                    attempt['mark'],
+                    attempt['reason'],
                 ]
             )
 
@@ -2262,41 +2543,47 @@ class WorkTimeBot:
     async def handle_sick_clear(self, message: types.Message, state: FSMContext):
         """Снятие больничного на сегодня"""
         user_id = message.from_user.id
-        if not await self.check_access(user_id):
-            await message.answer("Доступ запрещен.")
-            return
 
         today = self.moscow_today()
         async with self.pool.acquire() as conn:
-            sick_today = await conn.fetchval(
-                '''
-                SELECT id FROM time_logs
-                WHERE employee_id = (SELECT id FROM employees WHERE telegram_id = $1)
-                  AND date = $2 AND status = 'sick'
-                LIMIT 1
-                ''',
-                user_id,
-                today,
-            )
-
-            if not sick_today:
-                await message.answer(
-                    "На сегодня больничный не установлен.",
-                    reply_markup=await self.build_main_keyboard_for_user(user_id),
+            employee = await self.get_active_employee(user_id, conn)
+            has_access = bool(employee and employee['is_approved'])
+            if has_access:
+                sick_today = await conn.fetchval(
+                    '''
+                    SELECT id FROM time_logs
+                    WHERE employee_id = $1
+                      AND date = $2 AND status = 'sick'
+                    LIMIT 1
+                    ''',
+                    employee['id'],
+                    today,
                 )
-                return
 
-            await conn.execute(
-                '''
-                DELETE FROM time_logs
-                WHERE id = $1
-                ''',
-                sick_today,
+                if sick_today:
+                    await conn.execute(
+                        '''
+                        DELETE FROM time_logs
+                        WHERE id = $1
+                        ''',
+                        sick_today,
+                    )
+                keyboard = await self.build_main_keyboard_for_user(user_id, conn)
+
+        if not has_access:
+            await message.answer("Доступ запрещен.")
+            return
+
+        if not sick_today:
+            await message.answer(
+                "На сегодня больничный не установлен.",
+                reply_markup=keyboard,
             )
+            return
 
         await message.answer(
             "Больничный снят. Можно отмечать приход.",
-            reply_markup=await self.build_main_keyboard_for_user(user_id),
+            reply_markup=keyboard,
         )
         await state.clear()
 
@@ -2306,10 +2593,11 @@ class WorkTimeBot:
         return False
 
     def _build_email_message(self, excel_file: io.BytesIO, subject: Optional[str]) -> MIMEMultipart:
+        now = self.moscow_now()
         message = MIMEMultipart()
         message['From'] = Config.SMTP_USERNAME
         message['To'] = ', '.join(Config.EMAIL_RECIPIENTS)
-        message['Subject'] = subject or f"Табель {datetime.now().strftime('%B %Y')}"
+        message['Subject'] = subject or f"Табель {now.strftime('%B %Y')}"
 
         message.attach(MIMEText("Табель учета рабочего времени во вложении", 'plain'))
 
@@ -2318,7 +2606,7 @@ class WorkTimeBot:
         encoders.encode_base64(attachment)
         attachment.add_header(
             'Content-Disposition',
-            f'attachment; filename="Табель_{datetime.now().strftime("%Y_%m")}.xlsx"'
+            f'attachment; filename="Табель_{now.strftime("%Y_%m")}.xlsx"'
         )
         message.attach(attachment)
         return message
@@ -2350,28 +2638,32 @@ class WorkTimeBot:
         with smtplib.SMTP(Config.SMTP_SERVER, Config.SMTP_PORT) as server:
             server.starttls()
             server.login(Config.SMTP_USERNAME, Config.SMTP_PASSWORD)
-            server.send_message(message)
+            # Сообщение сериализуется один раз и уходит одним буфером
+            server.sendmail(Config.SMTP_USERNAME, Config.EMAIL_RECIPIENTS, message.as_bytes())
     
     async def show_employees(self, callback: types.CallbackQuery):
         """Показать список сотрудников"""
         async with self.pool.acquire() as conn:
-            # Гарантируем наличие столбца position даже на старых БД
-            await self.ensure_column(conn, "employees", "position", "VARCHAR(100)")
-
             employees = await conn.fetch('''
-                SELECT full_name, position, telegram_id, is_admin,
-                       (SELECT COUNT(*) FROM time_logs WHERE employee_id = employees.id
-                        AND EXTRACT(MONTH FROM date) = EXTRACT(MONTH FROM CURRENT_DATE)) as days_worked
-                FROM employees WHERE is_approved = TRUE ORDER BY full_name
+                SELECT e.full_name, e.telegram_id,
+                       COALESCE(e.position, 'Не указана') AS display_position,
+                       CASE WHEN e.is_admin THEN 'Админ' ELSE 'Сотрудник' END AS display_role,
+                       COUNT(tl.id) AS days_worked
+                FROM employees e
+                LEFT JOIN time_logs tl ON tl.employee_id = e.id
+                    AND tl.date >= date_trunc('month', CURRENT_DATE)
+                    AND tl.date < date_trunc('month', CURRENT_DATE) + INTERVAL '1 month'
+                WHERE e.is_approved = TRUE
+                GROUP BY e.id
+                ORDER BY e.full_name
             ''')
-        
-        text = "Сотрудники:\n\n"
-        for emp in employees:
-            role = "Админ" if emp['is_admin'] else "Сотрудник"
-            position = emp['position'] or "Не указана"
-            text += f"{emp['full_name']}\n"
-            text += f"Должность: {position}\n"
-            text += f"Роль: {role}, ID: {emp['telegram_id']}, Дней: {emp['days_worked']}\n\n"
+
+        text = "Сотрудники:\n\n" + "".join(
+            f"{emp['full_name']}\n"
+            f"Должность: {emp['display_position']}\n"
+            f"Роль: {emp['display_role']}, ID: {emp['telegram_id']}, Дней: {emp['days_worked']}\n\n"
+            for emp in employees
+        )
 
         await callback.message.answer(text)
 
@@ -2422,19 +2714,18 @@ class WorkTimeBot:
     
     async def show_objects_admin(self, callback: types.CallbackQuery):
         """Показать объекты"""
-        async with self.pool.acquire() as conn:
-            objects = await conn.fetch('SELECT name, address, latitude, longitude FROM objects ORDER BY name')
+        objects = await self.get_objects_cached()
         
-        text = "Объекты:\n\n"
+        parts = ["Объекты:\n\n"]
         for obj in objects:
-            text += f"{obj['name']}\n"
+            parts.append(f"{obj['name']}\n")
             if obj['address']:
-                text += f"Адрес: {obj['address']}\n"
+                parts.append(f"Адрес: {obj['address']}\n")
             if obj['latitude']:
-                text += f"Координаты: {obj['latitude']:.4f}, {obj['longitude']:.4f}\n"
-            text += "\n"
-        
-        await callback.message.answer(text)
+                parts.append(f"Координаты: {obj['latitude']:.4f}, {obj['longitude']:.4f}\n")
+            parts.append("\n")
+
+        await callback.message.answer("".join(parts))
     
     async def show_stats(self, callback: types.CallbackQuery):
         """Показать статистику"""
@@ -2513,6 +2804,7 @@ class WorkTimeBot:
             )
 
         total_employees = len(employees)
+        names_by_id = {emp['id']: emp['full_name'] for emp in employees}
         hours_by_emp = {row['employee_id']: float(row['hours'] or 0) for row in month_rows}
         worked_ids = {
             row['employee_id']
@@ -2531,55 +2823,57 @@ class WorkTimeBot:
 
         worked_pct = (worked_count / total_employees * 100) if total_employees else 0
         
-        text = f"Статистика за {today.strftime('%B %Y')}:\n\n"
-        text += f"Активных сотрудников: {total_employees}\n"
-        text += f"Отметились в месяце: {worked_count} ({worked_pct:.0f}%)\n"
-        text += f"Всего часов: {total_hours:.1f}\n"
-        text += f"Рабочих дней (суммарно): {total_work_days}\n"
-        text += f"Больничных дней: {total_sick_days}\n"
-
-        text += "\nТоп по часам:\n"
+        parts = [
+            f"Статистика за {today.strftime('%B %Y')}:\n\n",
+            f"Активных сотрудников: {total_employees}\n",
+            f"Отметились в месяце: {worked_count} ({worked_pct:.0f}%)\n",
+            f"Всего часов: {total_hours:.1f}\n",
+            f"Рабочих дней (суммарно): {total_work_days}\n",
+            f"Больничных дней: {total_sick_days}\n",
+        ]
+
+        parts.append("\nТоп по часам:\n")
         if not top_hours:
-            text += "—\n"
+            parts.append("—\n")
         else:
-            for row in top_hours:
-                text += f"• {next(emp['full_name'] for emp in employees if emp['id'] == row['employee_id'])} — {float(row['hours'] or 0):.1f} ч, дней: {int(row['days_worked'] or 0)}\n"
+            parts.extend(
+                f"• {names_by_id[row['employee_id']]} — {float(row['hours'] or 0):.1f} ч, дней: {int(row['days_worked'] or 0)}\n"
+                for row in top_hours
+            )
 
-        text += "\nБольничные за месяц:\n"
+        parts.append("\nБольничные за месяц:\n")
         if not sick_leaders:
-            text += "—\n"
+            parts.append("—\n")
         else:
-            for row in sick_leaders:
-                text += f"• {next(emp['full_name'] for emp in employees if emp['id'] == row['employee_id'])} — {int(row['sick_days'] or 0)} дн.\n"
+            parts.extend(
+                f"• {names_by_id[row['employee_id']]} — {int(row['sick_days'] or 0)} дн.\n"
+                for row in sick_leaders
+            )
 
         if non_working:
-            text += "\nБез отметок в этом месяце:\n"
-            for name in non_working:
-                text += f"• {name}\n"
+            parts.append("\nБез отметок в этом месяце:\n")
+            parts.extend(f"• {name}\n" for name in non_working)
         else:
-            text += "\nВсе сотрудники отмечались в этом месяце.\n"
+            parts.append("\nВсе сотрудники отмечались в этом месяце.\n")
 
-        text += "\nСегодня:\n"
-        text += f"Работали: {today_stats['worked_today'] or 0}\n"
-        text += f"Часов: {today_stats['hours_today'] or 0:.1f}\n"
+        parts.append("\nСегодня:\n")
+        parts.append(f"Работали: {today_stats['worked_today'] or 0}\n")
+        parts.append(f"Часов: {today_stats['hours_today'] or 0:.1f}\n")
         if sick_today:
-            text += "Больничный сегодня:\n"
-            for row in sick_today:
-                text += f"• {row['full_name']}\n"
-        text += "Не отметили приход:\n"
+            parts.append("Больничный сегодня:\n")
+            parts.extend(f"• {row['full_name']}\n" for row in sick_today)
+        parts.append("Не отметили приход:\n")
         if not missing_checkins:
-            text += "—\n"
+            parts.append("—\n")
         else:
-            for row in missing_checkins:
-                text += f"• {row['full_name']}\n"
-        text += "Не отметили уход:\n"
+            parts.extend(f"• {row['full_name']}\n" for row in missing_checkins)
+        parts.append("Не отметили уход:\n")
         if not missing_checkouts:
-            text += "—"
+            parts.append("—")
         else:
-            for row in missing_checkouts:
-                text += f"• {row['full_name']}\n"
+            parts.extend(f"• {row['full_name']}\n" for row in missing_checkouts)
         
-        await callback.message.answer(text)
+        await callback.message.answer("".join(parts))
     
     # Планировщик
     async def setup_scheduler(self):
@@ -2636,15 +2930,18 @@ class WorkTimeBot:
                 today,
             )
 
-        for emp in employees:
+        async def remind(emp: asyncpg.Record):
             try:
-                await self.bot.send_message(
-                    emp['telegram_id'],
-                    "Не забудьте отметить приход!",
-                    reply_markup=self.get_main_keyboard(is_admin=emp['is_admin']),
-                )
+                async with self._send_limit:
+                    await self.bot.send_message(
+                        emp['telegram_id'],
+                        "Не забудьте отметить приход!",
+                        reply_markup=self.get_main_keyboard(is_admin=emp['is_admin']),
+                    )
             except Exception as e:
                 logger.error(f"Ошибка отправки напоминания о приходе: {e}")
+
+        await asyncio.gather(*(remind(emp) for emp in employees))
     
     async def remind_checkout(self):
         """Напоминание об уходе"""
@@ -2662,110 +2959,115 @@ class WorkTimeBot:
                 AND e.is_active = TRUE
             ''', today)
         
-        for emp in employees:
+        async def remind(emp: asyncpg.Record):
             try:
-                await self.bot.send_message(
-                    emp['telegram_id'],
-                    "Напоминание! Не забудьте отметить уход.",
-                    reply_markup=self.get_main_keyboard(is_admin=emp['is_admin'])
-                )
+                async with self._send_limit:
+                    await self.bot.send_message(
+                        emp['telegram_id'],
+                        "Напоминание! Не забудьте отметить уход.",
+                        reply_markup=self.get_main_keyboard(is_admin=emp['is_admin'])
+                    )
             except Exception as e:
                 logger.error(f"Ошибка отправки напоминания: {e}")
+
+        await asyncio.gather(*(remind(emp) for emp in employees))
     
     async def auto_checkout(self):
         """Автоматический уход в 20:00 с ограничением 8 часов"""
-        today = self.moscow_today()
+        now = self.moscow_now_naive()
+        today = now.date()
         if not self.is_working_day(today):
             logger.info("Пропускаем авто-уход в выходной/праздничный день: %s", today)
             return
 
-        async with self.pool.acquire() as conn:
-            logs = await conn.fetch('''
-                SELECT tl.id, e.telegram_id, e.full_name, e.is_admin, tl.check_in
-                FROM time_logs tl
-                JOIN employees e ON tl.employee_id = e.id
-                WHERE tl.date = $1 AND tl.check_in IS NOT NULL AND tl.check_out IS NULL
-            ''', today)
-        
-        now = self.moscow_now_naive()
-        for log in logs:
-            try:
-                hours = (now - log['check_in']).seconds / 3600
-                hours = min(max(0, math.ceil(hours)), Config.MAX_WORK_HOURS)
-
-                async with self.pool.acquire() as conn:
-                    await conn.execute('''
-                        UPDATE time_logs SET check_out = $1, hours_worked = $2 WHERE id = $3
-                    ''', now, hours, log['id'])
-                
-                await self.bot.send_message(
-                    log['telegram_id'],
-                    f"Автоматический уход в {now.strftime('%H:%M')}\nОтработано: {hours} ч.",
-                    reply_markup=self.get_main_keyboard(is_admin=log['is_admin'])
+        # Закрываем открытые записи одним запросом; часы считаются так же,
+        # как в calculate_hours
+        try:
+            async with self.pool.acquire() as conn:
+                logs = await conn.fetch(
+                    f'''
+                    UPDATE time_logs tl
+                    SET check_out = $2, hours_worked = {HOURS_WORKED_SQL}
+                    FROM employees e
+                    WHERE tl.employee_id = e.id
+                      AND tl.date = $1 AND tl.check_in IS NOT NULL AND tl.check_out IS NULL
+                    RETURNING tl.id, e.telegram_id, e.is_admin, tl.hours_worked::int AS hours
+                    ''',
+                    today,
+                    now,
+                    Config.MAX_WORK_HOURS,
                 )
+        except Exception as e:
+            logger.error(f"Ошибка автоматического ухода: {e}")
+            return
+
+        now_hm = now.strftime('%H:%M')
+
+        async def notify(log: asyncpg.Record):
+            try:
+                async with self._send_limit:
+                    await self.bot.send_message(
+                        log['telegram_id'],
+                        f"Автоматический уход в {now_hm}\nОтработано: {log['hours']} ч.",
+                        reply_markup=self.get_main_keyboard(is_admin=log['is_admin'])
+                    )
                 logger.info(
                     "Авто-уход: %s (%s) часов %.0f в %s",
                     log['telegram_id'],
                     log['id'],
-                    hours,
-                    now.strftime('%H:%M'),
+                    log['hours'],
+                    now_hm,
                 )
             except Exception as e:
                 logger.error(f"Ошибка автоматического ухода: {e}")
 
+        await asyncio.gather(*(notify(log) for log in logs))
+
     async def force_checkout_end_of_day(self):
         """Автоматический уход в 23:59, если сотрудник не отметился (ограничение 8 часов)"""
         today = self.moscow_today()
+        cutoff = datetime.combine(today, time(23, 59)).replace(tzinfo=None)
 
-        async with self.pool.acquire() as conn:
-            logs = await conn.fetch(
-                '''
-                SELECT tl.id, e.telegram_id, e.full_name, e.is_admin, tl.check_in
-                FROM time_logs tl
-                JOIN employees e ON tl.employee_id = e.id
-                WHERE tl.date = $1 AND tl.check_in IS NOT NULL AND tl.check_out IS NULL
-                ''',
-                today,
-            )
-
-        if not logs:
+        # Закрываем все открытые записи дня одним запросом; часы считаются так же,
+        # как в calculate_hours: округление вверх, не больше MAX_WORK_HOURS
+        try:
+            async with self.pool.acquire() as conn:
+                logs = await conn.fetch(
+                    f'''
+                    UPDATE time_logs tl
+                    SET check_out = $2, hours_worked = {HOURS_WORKED_SQL}
+                    FROM employees e
+                    WHERE tl.employee_id = e.id
+                      AND tl.date = $1 AND tl.check_in IS NOT NULL AND tl.check_out IS NULL
+                    RETURNING tl.id, e.telegram_id, e.is_admin, tl.hours_worked::int AS hours
+                    ''',
+                    today,
+                    cutoff,
+                    Config.MAX_WORK_HOURS,
+                )
+        except Exception as e:
+            logger.error(f"Ошибка ночного авто-ухода: {e}")
             return
 
-        cutoff = datetime.combine(today, time(23, 59)).replace(tzinfo=None)
-
-        for log in logs:
+        async def notify(log: asyncpg.Record):
             try:
-                hours = 0
-                if log['check_in']:
-                    hours = (cutoff - log['check_in']).total_seconds() / 3600
-                hours = min(max(0, math.ceil(hours)), Config.MAX_WORK_HOURS)
-
-                async with self.pool.acquire() as conn:
-                    await conn.execute(
-                        '''
-                        UPDATE time_logs
-                        SET check_out = $1, hours_worked = $2
-                        WHERE id = $3
-                        ''',
-                        cutoff,
-                        hours,
-                        log['id'],
+                async with self._send_limit:
+                    await self.bot.send_message(
+                        log['telegram_id'],
+                        f"День закрыт автоматически в 23:59\nОтработано: {log['hours']} ч.",
+                        reply_markup=self.get_main_keyboard(is_admin=log['is_admin']),
                     )
-
-                await self.bot.send_message(
-                    log['telegram_id'],
-                    f"День закрыт автоматически в 23:59\nОтработано: {hours} ч.",
-                    reply_markup=self.get_main_keyboard(is_admin=log['is_admin']),
-                )
                 logger.info(
                     "Ночной авто-уход: %s (%s) часов %.0f в 23:59",
                     log['telegram_id'],
                     log['id'],
-                    hours,
+                    log['hours'],
                 )
             except Exception as e:
                 logger.error(f"Ошибка ночного авто-ухода: {e}")
 
+        await asyncio.gather(*(notify(log) for log in logs))
+
     async def send_periodic_timesheet(self):
         """Автоматическая отправка табеля дважды в месяц"""
         today = self.moscow_today()
@@ -2780,17 +3082,22 @@ class WorkTimeBot:
                 logger.warning("Не удалось сформировать табель для плановой отправки")
                 return
 
-            for admin_id in Config.ADMIN_IDS:
+            # Один буфер на всех получателей вместо копии на каждую отправку
+            document = types.BufferedInputFile(
+                excel_file.getvalue(),
+                filename=f"Общий_табель_{today.strftime('%Y_%m_%d')}.xlsx",
+            )
+
+            async def send_to_admin(admin_id: int):
                 try:
                     await self.bot.send_document(
                         chat_id=admin_id,
-                        document=types.BufferedInputFile(
-                            excel_file.getvalue(),
-                            filename=f"Общий_табель_{today.strftime('%Y_%m_%d')}.xlsx",
-                        ),
+                        document=document,
                         caption="Плановая отправка общего табеля",
                     )
                 except Exception as send_err:
                     logger.error(f"Не удалось отправить табель администратору {admin_id}: {send_err}")
+
+            await asyncio.gather(*(send_to_admin(admin_id) for admin_id in Config.ADMIN_IDS))
         except Exception as e:
             logger.error(f"Ошибка плановой отправки табеля: {e}")